@@ -1,3 +1,5 @@
+from pipes import quote
+
 from fabric.colors import yellow
 from fabric.operations import prompt, sudo, run, local
 
@@ -5,6 +7,10 @@ from fabric.operations import prompt, sudo, run, local
 class DatabaseOperations(object):
     needs_password = True
     engine_name = 'mysql'
+    parallel_commands = ['mydumper', 'myloader']
+
+    # bulk load: commit per table instead of per statement, skip key checks
+    local_init_command = 'SET SESSION autocommit=0, foreign_key_checks=0, unique_checks=0'
 
     def database_exists(self, database_name):
         output = self.root_execute(
@@ -23,43 +29,163 @@ class DatabaseOperations(object):
                 password
             )
         )
+
+        # snapshots of the database, see create_snapshot
+        self.root_execute(
+            r"GRANT ALL PRIVILEGES ON \\`%s_snapshot_%%\\`.* TO '%s'@'localhost'" % (
+                database_name,
+                owner
+            )
+        )
         self.root_execute('FLUSH PRIVILEGES')
 
-    def backup_database(self, database_name, username, password, file_path):
-        command = 'mysqldump --user=\'%s\' --password=\'%s\' \'%s\' > %s' % (
+    def dump_command(self, database_name, username, password):
+        return 'mysqldump --user=\'%s\' --password=\'%s\' \'%s\'' % (
+            username,
+            password.replace("'", "\\'"),
+            database_name
+        )
+
+    def quote_name(self, name):
+        return '`%s`' % name
+
+    def query(self, database_name, username, password, sql):
+        output = run('mysql --batch --skip-column-names --user=\'%s\' --password=\'%s\' \'%s\' -e %s' % (
             username,
             password.replace("'", "\\'"),
             database_name,
-            file_path
+            quote(sql)
+        ))
+        return [line.split('\t') for line in output.splitlines() if line]
+
+    def get_schema(self, database_name, username, password):
+        """ Returns rows of ('table', name), ('primary_key', table, column, type) and ('foreign_key', table, column, table, column) """
+
+        return self.query(database_name, username, password, ' '.join([
+            "SELECT 'table', table_name FROM information_schema.tables",
+            "WHERE table_schema = DATABASE() AND table_type = 'BASE TABLE';",
+            "SELECT 'primary_key', table_name, column_name, data_type FROM information_schema.columns",
+            "WHERE table_schema = DATABASE() AND column_key = 'PRI';",
+            "SELECT 'foreign_key', table_name, column_name, referenced_table_name, referenced_column_name",
+            "FROM information_schema.key_column_usage",
+            "WHERE table_schema = DATABASE() AND referenced_table_name IS NOT NULL;",
+        ]))
+
+    def subset_dump_command(self, database_name, username, password, exclude_tables, data_tables, sequences=()):
+        """
+        Returns command writing schema of all tables except exclude_tables, and rows of data_tables to stdout
+        data_tables is a list of (table, where clause or None for all rows), dumped in that order.
+        """
+
+        dump = 'mysqldump --user=\'%s\' --password=\'%s\'' % (username, password.replace("'", "\\'"))
+        ignore = ''.join(' --ignore-table=%s' % quote('%s.%s' % (database_name, t)) for t in exclude_tables)
+
+        commands = ['%s --no-data%s %s' % (dump, ignore, quote(database_name))]
+
+        for table, where in data_tables:
+            options = '--no-create-info --skip-triggers --single-transaction'
+            if where:
+                options += ' --where=%s' % quote(where)
+
+            commands.append('%s %s %s %s' % (dump, options, quote(database_name), quote(table)))
+
+        return '{ %s; }' % ' && '.join(commands)
+
+    def create_snapshot(self, database_name, username, password, snapshot_name):
+        """ Copy database into snapshot schema, in a single transaction """
+
+        self.query(database_name, username, password, 'DROP DATABASE IF EXISTS `%s`; CREATE DATABASE `%s`' % (
+            snapshot_name,
+            snapshot_name
+        ))
+        return run('set -o pipefail; %s --single-transaction | mysql --batch --user=\'%s\' --password=\'%s\' \'%s\'' % (
+            self.dump_command(database_name, username, password),
+            username,
+            password.replace("'", "\\'"),
+            snapshot_name
+        ))
+
+    def restore_snapshot(self, database_name, username, password, snapshot_name):
+        """ Swap tables of database and snapshot schema with a single atomic RENAME TABLE """
+
+        def get_tables(schema_name):
+            rows = self.query(database_name, username, password, ' '.join([
+                "SELECT table_name FROM information_schema.tables",
+                "WHERE table_schema = '%s' AND table_type = 'BASE TABLE'" % schema_name,
+            ]))
+            return [row[0] for row in rows]
+
+        old_name = '%s_old' % snapshot_name
+        renames = ['`%s`.`%s` TO `%s`.`%s`' % (database_name, t, old_name, t) for t in get_tables(database_name)]
+        renames += ['`%s`.`%s` TO `%s`.`%s`' % (snapshot_name, t, database_name, t) for t in get_tables(snapshot_name)]
+
+        self.query(database_name, username, password, 'CREATE DATABASE `%s`; RENAME TABLE %s' % (old_name, ', '.join(renames)))
+        self.query(database_name, username, password, 'DROP DATABASE `%s`; DROP DATABASE `%s`' % (old_name, snapshot_name))
+
+    def drop_snapshot(self, database_name, username, password, snapshot_name):
+        self.query(database_name, username, password, 'DROP DATABASE IF EXISTS `%s`' % snapshot_name)
+
+    def backup_database(self, database_name, username, password, file_path, compress_command=None):
+        command = self.dump_command(database_name, username, password)
+
+        if compress_command:
+            return run('set -o pipefail; %s | %s > %s' % (command, compress_command, file_path))
+
+        return run('%s > %s' % (command, file_path))
+
+    def recreate_database(self, database_name, username, password, run_command=run):
+        run_command(
+            'mysqladmin -f --user="%s" --password="%s" drop "%s"' % (username, password, database_name)
+        )
+        run_command(
+            'mysqladmin --user="%s" --password="%s" create "%s"' % (username, password, database_name)
         )
-        run(command)
 
-    def restore_database(self, database_name, username, password, file_path, run_command=run):
-        def drop_database():
-            run_command(
-                'mysqladmin -f --user="%s" --password="%s" drop "%s"' % (username, password, database_name)
-            )
+    def restore_database(self, database_name, username, password, file_path, run_command=run, decompress_command=None):
+        self.recreate_database(database_name, username, password, run_command=run_command)
+        return self.execute_file(
+            database_name, username, password, file_path, run_command=run_command, decompress_command=decompress_command
+        )
 
-        def create_database():
-            run_command(
-                'mysqladmin --user="%s" --password="%s" create "%s"' % (username, password, database_name)
+    def backup_database_parallel(self, database_name, username, password, backup_path, workers):
+        # LOCK TABLES instead of FLUSH TABLES WITH READ LOCK, which needs the global RELOAD privilege
+        return run(
+            'mydumper --user=\'%s\' --password=\'%s\' --database=\'%s\' --outputdir=%s --threads=%d --lock-all-tables --compress' % (
+                username,
+                password.replace("'", "\\'"),
+                database_name,
+                backup_path,
+                workers
             )
+        )
 
-        drop_database()
-        create_database()
-        self.execute_file(database_name, username, password, file_path, run_command=run_command)
-
-    def execute_file(self, database_name, username, password, file_path, options='', run_command=run):
-        return run_command(
-            'mysql --batch --user=%(user)s --password=%(password)s --database=name %(database)s %(options)s < %(file)s' % dict(
-                user=username,
-                password=password,
-                database=database_name,
-                options=options,
-                file=file_path
+    def restore_database_parallel(self, database_name, username, password, backup_path, workers):
+        self.recreate_database(database_name, username, password)
+        return run(
+            'myloader --user="%s" --password="%s" --database="%s" --directory=%s --threads=%d --overwrite-tables' % (
+                username,
+                password,
+                database_name,
+                backup_path,
+                workers
             )
         )
 
+    def execute_file(self, database_name, username, password, file_path, options='', run_command=run, decompress_command=None):
+        command = 'mysql --batch --user=%(user)s --password=%(password)s --database=name %(database)s %(options)s' % dict(
+            user=username,
+            password=password,
+            database=database_name,
+            options=options
+        )
+
+        # a truncated or corrupt backup has to fail the restore, run_command may be local, which uses sh
+        if decompress_command:
+            pipeline = 'set -o pipefail; %s < %s | %s' % (decompress_command, file_path, command)
+            return run_command('bash -c %s' % quote(pipeline))
+
+        return run_command('%s < %s' % (command, file_path))
+
     def root_execute(self, sql, options=''):
         return sudo(
             'mysql --batch --user=root --password=%s %s -e "%s"' % (
@@ -75,9 +201,26 @@ class DatabaseOperations(object):
 
         return self._root_password
 
-    def restore_local_database(self, backup_file, django_settings):
+    def prepare_local_database(self, django_settings):
         database_name = django_settings.DATABASES['default']['NAME']
         database_user = django_settings.DATABASES['default']['USER']
         database_password = django_settings.DATABASES['default']['PASSWORD']
 
-        self.restore_database(database_name, database_user, database_password, backup_file, run_command=local)
\ No newline at end of file
+        self.recreate_database(database_name, database_user, database_password, run_command=local)
+
+    def local_restore_command(self, django_settings):
+        return '(cat; echo "COMMIT;") | mysql --batch --user="%s" --password="%s" --init-command="%s" "%s"' % (
+            django_settings.DATABASES['default']['USER'],
+            django_settings.DATABASES['default']['PASSWORD'],
+            self.local_init_command,
+            django_settings.DATABASES['default']['NAME']
+        )
+
+    def restore_local_database(self, backup_file, django_settings, decompress_command=None):
+        self.prepare_local_database(django_settings)
+
+        return local('bash -c %s' % quote('set -o pipefail; %s < %s | %s' % (
+            decompress_command or 'cat',
+            backup_file,
+            self.local_restore_command(django_settings)
+        )))
@@ -1,9 +1,15 @@
+from pipes import quote
+
 from fabric.operations import sudo, run, local
 
 
 class DatabaseOperations(object):
     needs_password = False
     engine_name = 'postgresql_psycopg2'
+    parallel_commands = ['pg_dump', 'pg_restore']
+
+    # bulk load: don't wait for WAL flushes, more memory for the index builds at the end of the dump
+    local_pgoptions = '-c synchronous_commit=off -c maintenance_work_mem=512MB'
 
     def database_exists(self, database_name):
         output = self.execute("select 1 from pg_database where datname='%s'" % database_name)
@@ -24,15 +30,140 @@ class DatabaseOperations(object):
         else:
             run(command)
 
-    def backup_database(self, database_name, username, password, file_path):
-        run(
-            'pg_dump --no-owner %s > %s' % (database_name, file_path)
+    def dump_command(self, database_name, username, password):
+        return 'pg_dump --no-owner %s' % database_name
+
+    def quote_name(self, name):
+        return '"%s"' % name
+
+    def query(self, database_name, username, password, sql):
+        output = run('psql -X -t -A -F %s -d %s -c %s' % (quote('\t'), database_name, quote(sql)))
+        return [line.split('\t') for line in output.splitlines() if line]
+
+    def get_schema(self, database_name, username, password):
+        """
+        Returns rows of ('table', name), ('primary_key', table, column, type), ('foreign_key', table, column, table, column)
+        and ('sequence', name)
+        """
+
+        return self.query(database_name, username, password, ' '.join([
+            "SELECT 'table', c.relname::text, '', '', '' FROM pg_class c",
+            "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = 'public' AND c.relkind = 'r'",
+            "UNION ALL",
+            "SELECT 'primary_key', c.relname::text, a.attname::text, format_type(a.atttypid, a.atttypmod), '' FROM pg_index i",
+            "JOIN pg_class c ON c.oid = i.indrelid JOIN pg_namespace n ON n.oid = c.relnamespace",
+            "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)",
+            "WHERE n.nspname = 'public' AND i.indisprimary",
+            "UNION ALL",
+            "SELECT 'foreign_key', c.relname::text, a.attname::text, fc.relname::text, fa.attname::text FROM pg_constraint k",
+            "JOIN pg_class c ON c.oid = k.conrelid JOIN pg_namespace n ON n.oid = c.relnamespace",
+            "JOIN pg_class fc ON fc.oid = k.confrelid",
+            "JOIN pg_attribute a ON a.attrelid = k.conrelid AND a.attnum = k.conkey[1]",
+            "JOIN pg_attribute fa ON fa.attrelid = k.confrelid AND fa.attnum = k.confkey[1]",
+            "WHERE n.nspname = 'public' AND k.contype = 'f'",
+            "UNION ALL",
+            "SELECT 'sequence', c.relname::text, '', '', '' FROM pg_class c",
+            "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = 'public' AND c.relkind = 'S'",
+        ]))
+
+    def subset_dump_command(self, database_name, username, password, exclude_tables, data_tables, sequences=()):
+        """
+        Returns command writing schema of all tables except exclude_tables, and rows of data_tables to stdout
+        data_tables is a list of (table, where clause or None for all rows), copied in that order in a single snapshot.
+        Indexes and constraints are created after the rows, sequences are set to their remote values.
+        """
+
+        exclude = ''.join(' --exclude-table=%s' % quote('public.%s' % t) for t in exclude_tables)
+
+        copy_script = ['BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;']
+        for table, where in data_tables:
+            select = 'SELECT * FROM %s' % self.quote_name(table)
+            if where:
+                select += ' WHERE %s' % where
+
+            copy_script.extend([
+                "\\echo 'COPY public.%s FROM stdin;'" % self.quote_name(table),
+                'COPY (%s) TO STDOUT;' % select,
+                "\\echo '\\\\.'",
+            ])
+        copy_script.append('COMMIT;')
+
+        commands = [
+            'pg_dump --no-owner --section=pre-data%s %s' % (exclude, database_name),
+            'printf %%s %s | psql -q -X -v ON_ERROR_STOP=1 -d %s' % (quote('\n'.join(copy_script) + '\n'), database_name),
+        ]
+
+        if sequences:
+            commands.append('pg_dump --data-only%s %s' % (''.join(' --table=%s' % quote('public.%s' % s) for s in sequences), database_name))
+
+        commands.append('pg_dump --no-owner --section=post-data%s %s' % (exclude, database_name))
+
+        return '{ %s; }' % ' && '.join(commands)
+
+    def create_snapshot(self, database_name, username, password, snapshot_name):
+        """ Copy database into snapshot database, which needs a moment without connections to the database """
+
+        run('dropdb --if-exists %s' % snapshot_name)
+        return run(self._without_connections(database_name, 'createdb --template=%s %s' % (database_name, snapshot_name)))
+
+    def restore_snapshot(self, database_name, username, password, snapshot_name):
+        """ Swap database and snapshot database by renaming both in one transaction """
+
+        old_name = '%s_old' % snapshot_name
+        rename = 'ALTER DATABASE "%s" RENAME TO "%s"; ALTER DATABASE "%s" RENAME TO "%s";' % (
+            database_name,
+            old_name,
+            snapshot_name,
+            database_name
+        )
+
+        run(self._without_connections(database_name, 'psql -X -q -d postgres -c %s' % quote(rename)))
+        run('dropdb %s' % old_name)
+
+    def drop_snapshot(self, database_name, username, password, snapshot_name):
+        run('dropdb --if-exists %s' % snapshot_name)
+
+    def _without_connections(self, database_name, command):
+        """ Returns command running command after ending connections to database, retried while the site reconnects """
+
+        terminate = 'SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = \'%s\' AND pid <> pg_backend_pid()' % (
+            database_name
+        )
+
+        return '(for attempt in 1 2 3 4 5; do psql -X -q -t -d postgres -c %s > /dev/null; %s && exit 0; sleep 1; done; exit 1)' % (
+            quote(terminate),
+            command
         )
 
-    def restore_database(self, database_name, username, password, file_path):
+    def backup_database(self, database_name, username, password, file_path, compress_command=None):
+        command = self.dump_command(database_name, username, password)
+
+        if compress_command:
+            return run('set -o pipefail; %s | %s > %s' % (command, compress_command, file_path))
+
+        return run('%s > %s' % (command, file_path))
+
+    def restore_database(self, database_name, username, password, file_path, decompress_command=None):
         run('dropdb %s' % database_name)
         self._create_database(database_name, username, False)
-        run('psql -d %s -f %s' % (database_name, file_path))
+        return run(self._psql_file_command(database_name, file_path, decompress_command))
+
+    def backup_database_parallel(self, database_name, username, password, backup_path, workers):
+        return run(
+            'pg_dump --no-owner --format=directory --jobs=%d --file=%s %s' % (workers, backup_path, database_name)
+        )
+
+    def restore_database_parallel(self, database_name, username, password, backup_path, workers):
+        run('dropdb %s' % database_name)
+        self._create_database(database_name, username, False)
+        return run('pg_restore --no-owner --exit-on-error --jobs=%d --dbname=%s %s' % (workers, database_name, backup_path))
+
+    def _psql_file_command(self, database_name, file_path, decompress_command=None):
+        # a truncated or corrupt backup has to fail the restore
+        if decompress_command:
+            return 'set -o pipefail; %s < %s | psql -d %s' % (decompress_command, file_path, database_name)
+
+        return 'psql -d %s -f %s' % (database_name, file_path)
 
     def execute(self, sql):
         return sudo(
@@ -47,7 +178,7 @@ class DatabaseOperations(object):
         output = self.execute("SELECT 1 FROM pg_roles WHERE rolname='%s'" % user)
         return output == '1'
 
-    def restore_local_database(self, backup_file, django_settings):
+    def prepare_local_database(self, django_settings):
         database_name = django_settings.DATABASES['default']['NAME']
         database_user = django_settings.DATABASES['default']['USER']
 
@@ -55,7 +186,22 @@ class DatabaseOperations(object):
 
         if result.return_code != 0:
             raise Exception('Could not remove local database')
-        else:
-            local('createdb %s --owner=%s --encoding=utf8' % (database_name, database_user))
-            local('psql -d %s -f %s' % (database_name, backup_file))
+
+        local('createdb %s --owner=%s --encoding=utf8' % (database_name, database_user))
+
+    def local_restore_command(self, django_settings):
+        return 'PGOPTIONS="%s" psql -d %s' % (self.local_pgoptions, django_settings.DATABASES['default']['NAME'])
+
+    def restore_local_database(self, backup_file, django_settings, decompress_command=None):
+        self.prepare_local_database(django_settings)
+
+        result = local('bash -c %s' % quote('set -o pipefail; %s < %s | %s' % (
+            decompress_command or 'cat',
+            backup_file,
+            self.local_restore_command(django_settings)
+        )))
+
+        if result.succeeded:
             local('rm %s' % backup_file)
+
+        return result
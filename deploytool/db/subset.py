@@ -0,0 +1,163 @@
+"""
+Subset of a database for local development
+
+Rows are selected per table with a limit (the newest rows by primary key) or a percentage (by primary key modulo 100).
+Foreign keys stay valid: a table also gets every row referenced by the selected rows of the tables referencing it.
+Tables are dumped referencing tables first, so rows added during the dump can only add to the referenced rows.
+"""
+from fabric.api import *
+from fabric.colors import *
+
+
+# primary key types a limit or percentage can be applied to
+INTEGER_TYPES = ['bigint', 'int', 'integer', 'mediumint', 'smallint', 'tinyint']
+
+
+def get_subset_dump_command(database_operations, database_name, username, password, subset):
+    """
+    Returns remote command writing a subset of the database to stdout
+
+        subset = {
+            'limit': 1000,                              # rows per table, or a percentage like '10%'
+            'tables': {'auth_user': None},              # per table limits, None copies all rows
+            'exclude': ['south_migrationhistory'],      # tables left out completely
+            'schema_only': ['django_session'],          # tables created without rows
+        }
+    """
+
+    with settings(hide('running', 'stdout')):
+        schema = database_operations.get_schema(database_name, username, password)
+
+    tables = [row[1] for row in schema if row[0] == 'table']
+    sequences = [row[1] for row in schema if row[0] == 'sequence']
+
+    exclude_tables = [t for t in subset.get('exclude', []) if t in tables]
+    schema_only = subset.get('schema_only', [])
+    tables = [t for t in tables if t not in exclude_tables]
+
+    limits = dict((t, subset.get('limit')) for t in tables)
+    limits.update(subset.get('tables', {}))
+
+    # only single column integer primary keys can be sampled
+    primary_keys = {}
+    for row in [r for r in schema if r[0] == 'primary_key']:
+        primary_keys.setdefault(row[1], []).append((row[2], row[3].split('(')[0].split()[0].lower()))
+
+    primary_keys = dict(
+        (table, columns[0][0]) for table, columns in primary_keys.items()
+        if len(columns) == 1 and columns[0][1] in INTEGER_TYPES
+    )
+
+    # per table: (referencing table, referencing column, referenced column)
+    referenced_by = dict((t, []) for t in tables)
+    all_rows = set()
+
+    for row in [r for r in schema if r[0] == 'foreign_key']:
+        table, column, referenced_table, referenced_column = row[1:5]
+
+        if table in referenced_by and table not in schema_only and (
+                referenced_table in exclude_tables or referenced_table in schema_only):
+            print(yellow('Foreign key %s.%s will not be valid, %s has no rows.' % (table, column, referenced_table)))
+
+        if table not in referenced_by or referenced_table not in referenced_by or table in schema_only:
+            continue
+
+        # a self referencing table can't be sampled without walking the references
+        if table == referenced_table:
+            all_rows.add(table)
+        else:
+            referenced_by[referenced_table].append((table, column, referenced_column))
+
+    thresholds = get_thresholds(database_operations, database_name, username, password, dict(
+        (t, limits[t]) for t in tables
+        if t in primary_keys and t not in all_rows and t not in schema_only and is_row_limit(limits[t])
+    ), primary_keys)
+
+    quote_name = database_operations.quote_name
+    predicates = {}
+    data_tables = []
+    pending = [t for t in tables if t not in schema_only]
+
+    while pending:
+        ready = [t for t in pending if all(r[0] in predicates for r in referenced_by[t])]
+
+        # tables in a reference cycle get all rows, so every reference is kept
+        if not ready:
+            print(yellow('Copying all rows of %s, their foreign keys form a cycle.' % ', '.join(pending)))
+            ready = pending
+            all_rows.update(pending)
+
+        for table in ready:
+            predicates[table] = get_predicate(
+                table, limits[table], primary_keys.get(table), thresholds, table in all_rows, quote_name
+            )
+
+            # rows referenced by the selected rows of referencing tables
+            if predicates[table]:
+                clauses = [predicates[table]]
+
+                for referencing_table, column, referenced_column in referenced_by[table]:
+                    select = 'SELECT %s FROM %s' % (quote_name(column), quote_name(referencing_table))
+                    if predicates.get(referencing_table):
+                        select += ' WHERE %s' % predicates[referencing_table]
+
+                    # derived table, so mysql runs the subquery once
+                    clauses.append('%s IN (SELECT %s FROM (%s) AS subset_%d)' % (
+                        quote_name(referenced_column), quote_name(column), select, len(predicates)
+                    ))
+
+                predicates[table] = ' OR '.join('(%s)' % c for c in clauses)
+
+            data_tables.append((table, predicates[table]))
+
+        pending = [t for t in pending if t not in ready]
+
+    return database_operations.subset_dump_command(
+        database_name, username, password, exclude_tables, data_tables, sequences
+    )
+
+
+def is_row_limit(limit):
+    """ Check if limit is a number of rows, as opposed to a percentage or None """
+
+    return limit is not None and not str(limit).endswith('%')
+
+
+def get_predicate(table, limit, primary_key, thresholds, all_rows, quote_name):
+    """ Returns where clause sampling table by limit, or None for all rows """
+
+    if all_rows or limit is None or not primary_key:
+        return None
+
+    if str(limit).endswith('%'):
+        return 'MOD(%s, 100) < %d' % (quote_name(primary_key), int(float(str(limit)[:-1])))
+
+    # empty table
+    if thresholds.get(table) is None:
+        return None
+
+    return '%s >= %s' % (quote_name(primary_key), thresholds[table])
+
+
+def get_thresholds(database_operations, database_name, username, password, limits, primary_keys):
+    """ Returns dict with per table the lowest primary key of its newest `limit` rows, in a single query """
+
+    if not limits:
+        return {}
+
+    quote_name = database_operations.quote_name
+    selects = []
+
+    for table, limit in sorted(limits.items()):
+        selects.append("SELECT '%s', MIN(s.pk) FROM (SELECT %s AS pk FROM %s ORDER BY %s DESC LIMIT %d) AS s" % (
+            table,
+            quote_name(primary_keys[table]),
+            quote_name(table),
+            quote_name(primary_keys[table]),
+            int(limit)
+        ))
+
+    with settings(hide('running', 'stdout')):
+        rows = database_operations.query(database_name, username, password, ' UNION ALL '.join(selects))
+
+    return dict((row[0], row[1]) for row in rows if len(row) > 1 and row[1] not in ('', 'NULL'))
@@ -12,6 +12,8 @@ import deploytool
 from deploytool.db import get_database_operations
 
 from deploytool.utils.commands import get_python_version
+from deploytool.utils.facts import get_host_facts, forget_host_facts
+from deploytool.utils.session import get_connection
 
 
 class ProvisioningTask(Task):
@@ -37,6 +39,7 @@ class ProvisioningTask(Task):
             # make sure local user either knows remote password, or has its local public key on remote end
             print(green('\nConnecting with user %s' % magenta(env.provisioning_user)))
             env.update({'user': env.provisioning_user})
+            get_connection()
 
             # ask for sudo session up front
             sudo('ls')
@@ -173,6 +176,11 @@ class Setup(ProvisioningTask):
         for folder in folders_to_create:
             sudo('mkdir %s' % folder)
 
+        # host-wide cache shared by all projects on this host
+        if env.shared_cache_path:
+            print(green('\nSetting up shared cache `%s`' % env.shared_cache_path))
+            setup_shared_cache(project_user)
+
         # [3] copy files
         database_operations = get_database_operations(env.database_engine)
 
@@ -215,6 +223,9 @@ class Setup(ProvisioningTask):
                 use_sudo=True
             )
 
+        # credentials.json was just created
+        forget_host_facts()
+
         # [5] create new database + user with all schema privileges (uses database root user)
         print(green('\nCreating database `%s` with privileged db-user `%s`' % (
             database_name,
@@ -322,10 +333,7 @@ class Setup(ProvisioningTask):
 
         If no path is found, then abort.
         """
-        apache_conf_path = self.find_first_existing_path(
-            os.path.join('/', 'etc', 'httpd', 'conf.d'),
-            os.path.join('/', 'etc', 'apache2', 'conf.d')
-        )
+        apache_conf_path = get_host_facts()['apache_conf_path']
 
         if apache_conf_path:
             return apache_conf_path
@@ -339,36 +347,45 @@ class Setup(ProvisioningTask):
 
         If no path is found, then abort.
         """
-        apache_daemon = self.find_first_existing_path(
-            os.path.join('/', 'etc', 'init.d', 'httpd'),
-            os.path.join('/', 'etc', 'init.d', 'apache2')
-        )
+        apache_daemon = get_host_facts()['apache_daemon']
 
         if apache_daemon:
             return apache_daemon
         else:
             abort(red('apache daemon not found'))
 
-    def find_first_existing_path(self, *paths):
-        """
-        Find the first path that exists. If no path is found, return None.
-        """
-        for path in paths:
-            if exists(path):
-                return path
-
-        return None
-
     def run_apache_configtest(self):
         """
         Return apache configtest using apachectl or apache daemon.
         """
-        if run('which apachectl', quiet=True):
+        if 'apachectl' in get_host_facts()['commands']:
             sudo('apachectl configtest')
         else:
             sudo('%s configtest' % self.get_apache_daemon())
 
 
+class SharedCache(ProvisioningTask):
+    """
+    PROV - Set up the shared cache for an existing project
+
+        Creates `shared_cache_path` if no other project on the host did, and gives the project user access to it.
+        New projects get this from `setup`.
+    """
+
+    name = 'setup_shared_cache'
+    requirements = [
+        'project_name',
+        'project_name_prefix',
+        'provisioning_user',
+        'shared_cache_path',
+    ]
+
+    def __call__(self):
+
+        print(green('\nSetting up shared cache `%s`' % env.shared_cache_path))
+        setup_shared_cache(env.project_name_prefix + env.project_name)
+
+
 class Keys(ProvisioningTask):
     """
     PROV - Enable devs for project by managing SSH keys
@@ -388,6 +405,7 @@ class Keys(ProvisioningTask):
     def __call__(self):
 
         project_user = env.project_name_prefix + env.project_name
+        self._authorized_keys = None
         local_ssh_path = os.path.join(os.environ['HOME'], '.ssh')
         local_ssh_files = os.listdir(local_ssh_path)
         local_key_files = [f for f in local_ssh_files if f[-4:] == '.pub']
@@ -446,14 +464,40 @@ class Keys(ProvisioningTask):
             print(green('\nTransferring key'))
             print(key_to_transfer)
             append(remote_auth_keys, key_to_transfer, use_sudo=True)
+            self._authorized_keys.append(key_to_transfer)
 
     def _read_key(self, key_file):
         """ Returns the content of a (public) SSH key-file """
 
-        return '%s' % local('cat %s' % key_file, capture=True).strip()
+        with open(key_file) as f:
+            return f.read().strip()
 
     def _is_key_authorized(self, auth_keys_file, public_key):
-        """ Checks if key is present in supplied authorized_keys file """
+        """ Checks if key is present in supplied authorized_keys file (read once per task) """
+
+        if self._authorized_keys is None:
+            self._authorized_keys = sudo('cat %s' % auth_keys_file).split('\r\n')
+
+        return bool(public_key in self._authorized_keys)
+
+
+def setup_shared_cache(project_user):
+    """
+    Create shared cache (once per host) and give project user access to it
+
+        - every project user is member of the `shared_cache_group`
+        - folders are setgid, so new files belong to that group
+        - default ACLs make new files group writable, regardless of umask
+    """
 
-        authorized_keys = sudo('cat %s' % auth_keys_file)
-        return bool(public_key in authorized_keys.split('\r\n'))
+    sudo('groupadd -f %s' % env.shared_cache_group)
+    sudo('usermod -a -G %s %s' % (env.shared_cache_group, project_user))
+
+    if not exists(env.shared_cache_path, use_sudo=True):
+        sudo('mkdir -p %s %s' % (
+            os.path.join(env.shared_cache_path, 'download'),
+            os.path.join(env.shared_cache_path, 'wheels')
+        ))
+        sudo('chgrp -R %s %s' % (env.shared_cache_group, env.shared_cache_path))
+        sudo('chmod -R 2775 %s' % env.shared_cache_path)
+        sudo('setfacl -R -d -m g::rwX,o::rX %s' % env.shared_cache_path)
@@ -67,6 +67,45 @@ class RemoteHost(Task):
 
         env.setdefault('project_path_name', env.project_name)
         env.setdefault('database_engine', 'mysql')
+        env.setdefault('source_transfer', 'archive')
+        env.setdefault('upload_method', 'put')
+        env.setdefault('upload_compression', 'gzip')
+        env.setdefault('local_media_path', 'media')
+        env.setdefault('media_sync_workers', 4)
+        env.setdefault('download_method', 'stream')
+        env.setdefault('transfer_workers', 4)
+        env.setdefault('transfer_chunk_size', 64)
+        env.setdefault('backup_compression', 'auto')
+        env.setdefault('backup_compression_level', None)
+        env.setdefault('backup_format', 'sql')
+        env.setdefault('database_workers', None)
+        env.setdefault('database_subset', None)
+        env.setdefault('database_snapshot', False)
+        env.setdefault('skip_unchanged_database', False)
+        env.setdefault('schema_pathspecs', ['*/migrations/*', '*models.py', '*/models/*', '*settings*.py', 'requirements.txt'])
+        env.setdefault('artifact_cache', True)
+        env.setdefault('artifact_cache_path', os.path.join('~', '.cache', 'deploytool'))
+        env.setdefault('artifact_cache_size', 2048)
+        env.setdefault('compass_pathspecs', ['config.rb', '*.sass', '*.scss', 'static/*'])
+        env.setdefault('compass_recompile_local', True)
+        env.setdefault('parallel_deploy', False)
+        env.setdefault('deploy_pool_size', 4)
+        env.setdefault('reuse_virtualenv', False)
+        env.setdefault('dedup_instances', False)
+        env.setdefault('keep_instances', 3)
+        env.setdefault('instance_disk_budget', None)
+        env.setdefault('prune_in_background', False)
+        env.setdefault('disk_space_check', True)
+        env.setdefault('pip_wheelhouse', False)
+        env.setdefault('wheel_build_image', None)
+        env.setdefault('shared_cache_path', None)
+        env.setdefault('shared_cache_group', 'deploytool')
+        env.setdefault('shared_cache_size', 4096)
+        env.setdefault('ssh_keepalive', 30)
+
+        # Fabric has its own defaults for these, so setdefault would never apply
+        env.keepalive = env.ssh_keepalive
+        env.connection_attempts = self.settings.get('connection_attempts', 3)
 
 
 class RemoteTask(Task):
@@ -108,39 +147,46 @@ class RemoteTask(Task):
     def run(self, *args, **kwargs):
         """ Hide output, update fabric env, run task """
 
-        # hide fabric output
+        # hide fabric output, cache remote path state for the duration of the task
         with settings(hide('running', 'stdout'), warn_only=True):
-
-            # check if HOST task was run before this task
-            if not hasattr(env, 'current_instance_path'):
-                message = str.join(' ', [
-                    red('\nRun a HOST task before running this remote task (e.g. `fab staging deploy`).\n'),
-                    'Use `fab -l` to see a list of all available tasks.\n',
-                    'Use `fab -d %s` to see this task\'s details.\n' % self.name,
-                ])
-                abort(message)
-
-            # load current instance unless task already provided something else
-            if not hasattr(self, 'stamp'):
-                self.stamp = utils.instance.get_instance_stamp(env.current_instance_path)
-
-            # check if all required HOST settings are present in fabric environment
-            [require(r) for r in self.requirements]
-
-            # update fabric environment for instance settings
-            instance_path = os.path.join(env.vhost_path, self.stamp)
-            env.update({
-                'backup_path': os.path.join(instance_path, 'backup'),
-                'instance_stamp': self.stamp,
-                'instance_path': instance_path,
-                'source_path': os.path.join(instance_path, env.project_name),
-                'project_path': os.path.join(instance_path, env.project_name),
-                'project_project_path': os.path.join(instance_path, env.project_name, env.project_path_name),
-                'virtualenv_path': os.path.join(instance_path, 'env'),
-            })
-
-            # finally, run the task implementation!
-            self(*args, **kwargs)
+            with utils.commands.path_cache():
+
+                # check if HOST task was run before this task
+                if not hasattr(env, 'current_instance_path'):
+                    message = str.join(' ', [
+                        red('\nRun a HOST task before running this remote task (e.g. `fab staging deploy`).\n'),
+                        'Use `fab -l` to see a list of all available tasks.\n',
+                        'Use `fab -d %s` to see this task\'s details.\n' % self.name,
+                    ])
+                    abort(message)
+
+                # (re)connect, the connection is shared by all tasks and helpers in this session
+                utils.session.get_connection()
+
+                # gather host facts in a single remote command, cached for the rest of the session
+                utils.facts.get_host_facts()
+
+                # load current instance unless task already provided something else
+                if not hasattr(self, 'stamp'):
+                    self.stamp = utils.instance.get_instance_stamp(env.current_instance_path)
+
+                # check if all required HOST settings are present in fabric environment
+                [require(r) for r in self.requirements]
+
+                # update fabric environment for instance settings
+                instance_path = os.path.join(env.vhost_path, self.stamp)
+                env.update({
+                    'backup_path': os.path.join(instance_path, 'backup'),
+                    'instance_stamp': self.stamp,
+                    'instance_path': instance_path,
+                    'source_path': os.path.join(instance_path, env.project_name),
+                    'project_path': os.path.join(instance_path, env.project_name),
+                    'project_project_path': os.path.join(instance_path, env.project_name, env.project_path_name),
+                    'virtualenv_path': os.path.join(instance_path, 'env'),
+                })
+
+                # finally, run the task implementation!
+                self(*args, **kwargs)
 
 
 class Deployment(RemoteTask):
@@ -151,6 +197,9 @@ class Deployment(RemoteTask):
 
         # deployment using current git HEAD
         $ fab staging deploy
+
+        # deploy to all hosts at once
+        $ fab staging deploy:parallel
     """
 
     name = 'deploy'
@@ -162,44 +211,45 @@ class Deployment(RemoteTask):
             deploy by HEAD for current branch
         """
 
-        with settings(hide('warnings', 'running', 'stdout', 'stderr'), warn_only=True):
+        # already deployed by a parallel deploy
+        if env.host_string in env.get('parallel_deployed_hosts', []):
+            return
 
-            # check if remote stamp exists in local repo
-            current_instance = utils.commands.read_link(env.current_instance_path)
-            remote_stamp = utils.instance.get_instance_stamp(current_instance)
+        # remote path state looked up here is reused by the task run
+        with utils.commands.path_cache():
+            with settings(hide('warnings', 'running', 'stdout', 'stderr'), warn_only=True):
 
-            # first deploy to remote
-            if '/' in remote_stamp:
-                print(green('\nFirst deploy to remote.'))
+                # connect before the first remote command, which would otherwise open the connection itself
+                utils.session.get_connection()
 
-            # deployed commit is not in your local repository
-            elif remote_stamp and not utils.commands.remote_stamp_in_local_repo(remote_stamp):
-                print(red('\nWarning: deployed commit is not in your local repository.'))
+                # check if remote stamp exists in local repo
+                current_instance = utils.commands.read_link(env.current_instance_path)
+                remote_stamp = utils.instance.get_instance_stamp(current_instance)
 
-            # show changed files with `diff` command
-            else:
-                Diff().run()
+                # first deploy to remote
+                if '/' in remote_stamp:
+                    print(green('\nFirst deploy to remote.'))
 
-            # ask to deploy
-            self.stamp = utils.source.get_head()
-            _args = (utils.source.get_branch_name(), self.stamp)
+                # deployed commit is not in your local repository
+                elif remote_stamp and not utils.commands.remote_stamp_in_local_repo(remote_stamp):
+                    print(red('\nWarning: deployed commit is not in your local repository.'))
 
-            question = '\nDeploy branch %s at commit %s?' % _args
+                # show changed files with `diff` command
+                else:
+                    Diff().run()
 
-            if not confirm(yellow(question)):
-                abort(red('Aborted deployment. Run `fab -d %s` for options.' % self.name))
+                # ask to deploy
+                self.stamp = utils.source.get_head()
+                _args = (utils.source.get_branch_name(), self.stamp)
 
-        super(Deployment, self).run(*args, **kwargs)
+                question = '\nDeploy branch %s at commit %s?' % _args
 
-    def __call__(self, *args, **kwargs):
+                if not confirm(yellow(question)):
+                    abort(red('Aborted deployment. Run `fab -d %s` for options.' % self.name))
 
-        # check if deploy is possible
-        if self.stamp == utils.instance.get_instance_stamp(env.current_instance_path):
-            abort(red('Deploy aborted because %s is already the current instance.' % self.stamp))
-        if self.stamp == utils.instance.get_instance_stamp(env.previous_instance_path):
-            abort(red('Deploy aborted because %s is the previous instance. Use rollback task instead.' % self.stamp))
-        if exists(env.instance_path):
-            abort(red('Deploy aborted because instance %s has already been deployed.' % self.stamp))
+            super(Deployment, self).run(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
 
         """
         parse optional 'pause' argument, can be given like this:
@@ -208,167 +258,458 @@ class Deployment(RemoteTask):
         """
         pause_at = kwargs['pause'].split(',') if ('pause' in kwargs) else []
 
+        if (env.parallel_deploy or 'parallel' in args) and len(env.hosts) > 1:
+            self.deploy_parallel(pause_at, *args, **kwargs)
+            return
+
         # start deploy
+        self.stage_instance(pause_at, *args, **kwargs)
+
+        # update database
         try:
-            print(green('\nCreating folders.'))
-            folders_to_create = [
-                env.instance_path,
-                env.backup_path,
-                env.source_path,
-                env.virtualenv_path,
-            ]
-            for folder in folders_to_create:
-                utils.commands.create_folder(folder)
+            self.update_database(pause_at, *args, **kwargs)
+        except:
+            self.log(success=False)
+            self.restore_database_backup()
 
-            # before_deploy_source pause
-            if ('before_deploy_source' in pause_at):
-                print(green('\nOpening remote shell - before_deploy_source.'))
-                open_shell()
+            print(green('\nRemoving this instance from filesystem.'))
+            utils.commands.delete(env.instance_path)
 
-            # before_deploy_source hook
-            if ('before_deploy_source' in env):
-                env.before_deploy_source(env, *args, **kwargs)
+            abort(red('Deploy failed and was rolled back.'))
 
-            print(green('\nDeploying source.'))
-            utils.source.transfer_source(upload_path=env.source_path, tree=self.stamp)
+        self.before_restart(pause_at, *args, **kwargs)
+        self.switch_instance()
+        self.after_restart(pause_at, *args, **kwargs)
 
-            if env.compass_version:
-                # before_compass_compile pause
-                if ('before_compass_compile' in pause_at):
-                    print(green('\nOpening remote shell - before_compass_compile.'))
-                    open_shell()
+        self.log(success=True)
 
-                # before_compass_compile hook
-                if ('before_compass_compile' in env):
-                    env.before_deploy_source(env, *args, **kwargs)
+        # dedup walks the remaining instances, so it can't run alongside a removal in the background
+        utils.instance.prune_obsolete_instances(background=env.prune_in_background and not env.dedup_instances)
 
-                print(green('\nCompiling compass project and uploading static files.'))
-                utils.source.compass_compile(upload_path=env.source_path, tree=self.stamp, compass_version=env.compass_version)
+        if env.dedup_instances:
+            utils.dedup.deduplicate_instances(env.vhost_path)
 
-            # before_create_virtualenv pause
-            if ('before_create_virtualenv' in pause_at):
-                print(green('\nOpening remote shell - before_create_virtualenv.'))
-                open_shell()
+    def deploy_parallel(self, pause_at, *args, **kwargs):
+        """
+        Deploy to all hosts at once
 
-            # before_create_virtualenv hook
-            if ('before_create_virtualenv' in env):
-                env.before_create_virtualenv(env, *args, **kwargs)
+            - stages the instance on every host concurrently, in a pool of `deploy_pool_size` workers
+            - updates the database once, from the current host, the other hosts record that host for rollback
+            - switches all hosts only after every host staged successfully
+            - removes the instance from all hosts, and switches them back, when anything fails
+        """
 
-            print(green('\nCreating virtual environment.'))
-            utils.instance.create_virtualenv(env.virtualenv_path)
+        hosts = list(env.hosts)
+        database_host = env.host_string
 
-            # before_pip_install pause
-            if ('before_pip_install' in pause_at):
-                print(green('\nOpening remote shell - before_pip_install.'))
-                open_shell()
+        if pause_at:
+            abort(red('Deploy aborted because pausing is not possible in a parallel deploy.'))
+        if (env.compass_version or env.pip_wheelhouse) and not env.artifact_cache:
+            abort(red('Deploy aborted because a parallel deploy with compass or wheelhouse requires the artifact_cache setting.'))
 
-            # before_pip_install hook
-            if ('before_pip_install' in env):
-                env.before_pip_install(env, *args, **kwargs)
+        # build local artifacts once, so the workers only have to upload them
+        if env.artifact_cache and env.source_transfer != 'delta':
+            print(green('\nBuilding source archive.'))
+            utils.source.build_source_archive(self.stamp)
 
-            if exists(os.path.join(env.project_path, '*.pth')):
-                print(green('\nCopying .pth files.'))
-                utils.commands.copy(
-                    from_path=os.path.join(env.project_path, '*.pth'),
-                    to_path='%s/lib/python%s/site-packages' % (env.virtualenv_path, get_python_version())
-                )
+        if env.compass_version:
+            print(green('\nCompiling compass project.'))
+            utils.source.build_static_bundle(self.stamp, env.compass_version)
 
-            print(green('\nPip installing requirements.'))
-            # TODO: use requirements_path instead of project_path?
-            utils.instance.pip_install_requirements(
-                env.virtualenv_path,
-                env.project_path,
-                env.cache_path,
-                env.log_path
-            )
+        if env.pip_wheelhouse:
+            print(green('\nBuilding wheelhouse.'))
+            utils.wheelhouse.build_wheelhouse(self.stamp)
+
+        @parallel(pool_size=env.deploy_pool_size)
+        def stage():
+            self.stage_instance(pause_at, *args, **kwargs)
+            return True
+
+        print(green('\nStaging instance on %s.' % ', '.join(hosts)))
+        results = execute(stage, hosts=hosts)
+
+        # barrier: nothing is switched unless every host is ready
+        staged_hosts = [host for host in hosts if results.get(host) is True]
+        failed_hosts = [host for host in hosts if host not in staged_hosts]
+
+        if failed_hosts:
+            self.remove_instance(staged_hosts)
+            abort(red('Deploy failed on %s and was rolled back on all hosts.' % ', '.join(failed_hosts)))
+
+        try:
+            self.update_database(pause_at, *args, **kwargs)
+        except:
+            self.restore_database_backup()
+            self.remove_instance(hosts)
+            abort(red('Deploy failed and was rolled back on all hosts.'))
+
+        # only this host has the database backups, a rollback of the other hosts just switches instances
+        for host in hosts:
+            if host != database_host:
+                with settings(host_string=host):
+                    utils.instance.mark_database_host(env.backup_path, database_host)
+
+        self.before_restart(pause_at, *args, **kwargs)
+
+        switched_hosts = []
+        try:
+            for host in hosts:
+                with settings(host_string=host):
+                    switched_hosts.append(host)
+                    self.switch_instance()
+        except:
+            self.switch_back(switched_hosts)
+            self.restore_database_backup()
+            self.remove_instance(hosts)
+            abort(red('Deploy failed while switching instances and was rolled back on all hosts.'))
+
+        self.after_restart(pause_at, *args, **kwargs)
+
+        for host in hosts:
+            with settings(host_string=host):
+                self.log(success=True)
+                utils.instance.prune_obsolete_instances(background=env.prune_in_background and not env.dedup_instances)
+
+                if env.dedup_instances:
+                    utils.dedup.deduplicate_instances(env.vhost_path)
+
+        # Fabric still calls this task for the other hosts, which are deployed by now
+        env.parallel_deployed_hosts = hosts
+
+    def check_instance(self):
+        """ Abort if instance can't be deployed to current host, returns stamp of current instance """
+
+        current_stamp = utils.instance.get_instance_stamp(env.current_instance_path)
+        if self.stamp == current_stamp:
+            abort(red('Deploy aborted because %s is already the current instance.' % self.stamp))
+        if self.stamp == utils.instance.get_instance_stamp(env.previous_instance_path):
+            abort(red('Deploy aborted because %s is the previous instance. Use rollback task instead.' % self.stamp))
+        if utils.commands.path_exists(env.instance_path):
+            abort(red('Deploy aborted because instance %s has already been deployed.' % self.stamp))
+
+        return current_stamp
+
+    def check_disk_space(self):
+        """ Abort if the new instance, its virtualenv and database backups are not likely to fit on current host """
 
-            # after_pip_install pause
-            if ('after_pip_install' in pause_at):
-                print(green('\nOpening remote shell - after_pip_install.'))
+        free_disk = utils.facts.get_host_facts()['free_disk']
+        required = utils.instance.estimate_instance_size(utils.source.get_tree_size(self.stamp))
+
+        # free_disk is 0 when df could not tell
+        if free_disk and required > free_disk:
+            abort(red('Deploy aborted because it needs about %s of disk space and only %s is free. %s' % (
+                utils.commands.format_size(required),
+                utils.commands.format_size(free_disk),
+                'Run `fab %s remove_old_instances` or lower `keep_instances`.' % env.environment
+            )))
+
+    def stage_instance(self, pause_at, *args, **kwargs):
+        """ Create new instance on current host, the instance is removed again when anything fails """
+
+        current_stamp = self.check_instance()
+
+        if env.disk_space_check:
+            self.check_disk_space()
+
+        try:
+            self.create_instance(current_stamp, pause_at, *args, **kwargs)
+        except:
+            self.log(success=False)
+
+            print(yellow('\nRemoving this instance from filesystem.'))
+            utils.commands.delete(env.instance_path)
+
+            abort(red('Deploy failed and was rolled back.'))
+
+    def create_instance(self, current_stamp, pause_at, *args, **kwargs):
+        """ Folders, source, virtualenv, requirements, settings and static files """
+
+        print(green('\nCreating folders.'))
+        folders_to_create = [
+            env.instance_path,
+            env.backup_path,
+            env.source_path,
+            env.virtualenv_path,
+        ]
+        with utils.commands.batch():
+            for folder in folders_to_create:
+                utils.commands.create_folder(folder)
+
+        # before_deploy_source pause
+        if ('before_deploy_source' in pause_at):
+            print(green('\nOpening remote shell - before_deploy_source.'))
+            open_shell()
+
+        # before_deploy_source hook
+        if ('before_deploy_source' in env):
+            env.before_deploy_source(env, *args, **kwargs)
+
+        print(green('\nDeploying source.'))
+        self.deploy_source(current_stamp)
+
+        if env.compass_version:
+            # before_compass_compile pause
+            if ('before_compass_compile' in pause_at):
+                print(green('\nOpening remote shell - before_compass_compile.'))
                 open_shell()
 
-            # after_pip_install hook
-            if ('after_pip_install' in env):
-                env.after_pip_install(env, *args, **kwargs)
+            # before_compass_compile hook
+            if ('before_compass_compile' in env):
+                env.before_deploy_source(env, *args, **kwargs)
+
+            print(green('\nCompiling compass project and uploading static files.'))
+            utils.source.compass_compile(upload_path=env.source_path, tree=self.stamp, compass_version=env.compass_version)
+
+        # before_create_virtualenv pause
+        if ('before_create_virtualenv' in pause_at):
+            print(green('\nOpening remote shell - before_create_virtualenv.'))
+            open_shell()
+
+        # before_create_virtualenv hook
+        if ('before_create_virtualenv' in env):
+            env.before_create_virtualenv(env, *args, **kwargs)
+
+        requirements_hash = None
+        current_virtualenv_path = os.path.join(env.vhost_path, current_stamp, 'env')
 
-            print(green('\nCopying settings.py.'))
+        if env.reuse_virtualenv:
+            requirements_hash = utils.instance.get_requirements_hash(env.project_path)
+
+        if (requirements_hash and current_stamp and
+                requirements_hash == utils.instance.read_requirements_hash(current_virtualenv_path)):
+            print(green('\nCloning virtual environment of current instance, requirements are unchanged.'))
+            utils.instance.clone_virtualenv(current_virtualenv_path, env.virtualenv_path)
+        else:
+            pip_succeeded = self.build_virtualenv(pause_at, *args, **kwargs)
+
+            # a half installed virtual environment is never reused
+            if requirements_hash and pip_succeeded:
+                utils.instance.write_requirements_hash(env.virtualenv_path, requirements_hash)
+
+        print(green('\nCopying settings.py and linking media folder.'))
+        with utils.commands.batch():
             utils.commands.copy(
                 from_path=os.path.join(env.vhost_path, 'settings.py'),
                 to_path=os.path.join(env.project_project_path, 'settings.py')
             )
-
-            print(green('\nLinking media folder.'))
             utils.commands.create_symbolic_link(
                 real_path=os.path.join(env.vhost_path, 'media'),
                 symbolic_path=os.path.join(env.project_path, 'media')
             )
 
-            print(green('\nCollecting static files.'))
-            utils.commands.django_manage(
-                env.virtualenv_path,
-                env.project_path,
-                'collectstatic --link --noinput --verbosity=0 --traceback'
+        print(green('\nCollecting static files.'))
+        utils.commands.django_manage(
+            env.virtualenv_path,
+            env.project_path,
+            'collectstatic --link --noinput --verbosity=0 --traceback'
+        )
+
+    def build_virtualenv(self, pause_at, *args, **kwargs):
+        """ Create new virtual environment and install requirements, returns if pip install succeeded """
+
+        print(green('\nCreating virtual environment.'))
+        utils.instance.create_virtualenv(env.virtualenv_path)
+
+        # before_pip_install pause
+        if ('before_pip_install' in pause_at):
+            print(green('\nOpening remote shell - before_pip_install.'))
+            open_shell()
+
+        # before_pip_install hook
+        if ('before_pip_install' in env):
+            env.before_pip_install(env, *args, **kwargs)
+
+        if exists(os.path.join(env.project_path, '*.pth')):
+            print(green('\nCopying .pth files.'))
+            utils.commands.copy(
+                from_path=os.path.join(env.project_path, '*.pth'),
+                to_path='%s/lib/python%s/site-packages' % (env.virtualenv_path, get_python_version())
             )
-        except:
-            self.log(success=False)
 
-            print(yellow('\nRemoving this instance from filesystem.'))
-            utils.commands.delete(env.instance_path)
+        # the shared cache is missing for projects set up before it was configured
+        shared_cache_path = env.shared_cache_path
+        if shared_cache_path and not utils.instance.is_shared_cache_writable(shared_cache_path):
+            print(yellow('Shared cache %s is missing or not writable, using the project cache instead. %s' % (
+                shared_cache_path,
+                'Run `fab %s setup_shared_cache` to set it up.' % env.environment
+            )))
+            shared_cache_path = None
+
+        cache_path = env.cache_path
+        if shared_cache_path:
+            cache_path = os.path.join(shared_cache_path, 'download')
+
+        wheelhouse_path = None
+        if env.pip_wheelhouse and shared_cache_path:
+            print(green('\nUploading wheelhouse to shared cache.'))
+            wheelhouse_path = utils.wheelhouse.upload_shared_wheelhouse(self.stamp, shared_cache_path)
+        elif env.pip_wheelhouse:
+            print(green('\nUploading wheelhouse.'))
+            wheelhouse_path = os.path.join(env.instance_path, 'wheelhouse')
+            utils.wheelhouse.upload_wheelhouse(self.stamp, wheelhouse_path)
+
+        print(green('\nPip installing requirements.'))
+        # TODO: use requirements_path instead of project_path?
+        pip_result = utils.instance.pip_install_requirements(
+            env.virtualenv_path,
+            env.project_path,
+            cache_path,
+            env.log_path,
+            wheelhouse_path
+        )
 
-            abort(red('Deploy failed and was rolled back.'))
+        if wheelhouse_path and not shared_cache_path:
+            utils.commands.delete(wheelhouse_path)
 
-        # update database
-        try:
+        # after_pip_install pause
+        if ('after_pip_install' in pause_at):
+            print(green('\nOpening remote shell - after_pip_install.'))
+            open_shell()
+
+        # after_pip_install hook
+        if ('after_pip_install' in env):
+            env.after_pip_install(env, *args, **kwargs)
+
+        return pip_result.succeeded
+
+    def update_database(self, pause_at, *args, **kwargs):
+        """ Backup, syncdb, migrate and backup again, skipped when no schema changes are pending """
+
+        if not self.database_changes_pending(pause_at):
+            print(green('\nNo database changes pending, skipping backups and migrations.'))
+            utils.instance.mark_database_unchanged(env.backup_path)
+            return
+
+        snapshot_created = False
+        if env.database_snapshot:
+            print(green('\nSnapshotting database at start.'))
+            snapshot_created = utils.instance.snapshot_database(env.backup_path)
+
+            if not snapshot_created:
+                print(yellow('Could not snapshot database, making a backup instead.'))
+
+        if not snapshot_created:
             print(green('\nBacking up database at start.'))
             utils.instance.backup_database(
                 os.path.join(env.backup_path, 'db_backup_start.sql')
             )
 
-            with settings(show('stdout')):
+        with settings(show('stdout')):
 
-                # before_syncdb pause
-                if ('before_syncdb' in pause_at):
-                    print(green('\nOpening remote shell - before_syncdb.'))
-                    open_shell()
+            # before_syncdb pause
+            if ('before_syncdb' in pause_at):
+                print(green('\nOpening remote shell - before_syncdb.'))
+                open_shell()
 
-                # before_syncdb hook
-                if ('before_syncdb' in env):
-                    env.before_syncdb(env, *args, **kwargs)
+            # before_syncdb hook
+            if ('before_syncdb' in env):
+                env.before_syncdb(env, *args, **kwargs)
 
-                print(green('\nSyncing database.'))
-                utils.commands.django_manage(env.virtualenv_path, env.project_path, 'syncdb')
-                print('')
+            print(green('\nSyncing database.'))
+            syncdb_output = utils.commands.django_manage(env.virtualenv_path, env.project_path, 'syncdb')
+            print('')
 
-                # before_migrate pause
-                if ('before_migrate' in pause_at):
-                    print(green('\nOpening remote shell - before_migrate.'))
-                    open_shell()
+            # before_migrate pause
+            if ('before_migrate' in pause_at):
+                print(green('\nOpening remote shell - before_migrate.'))
+                open_shell()
 
-                # before_migrate hook
-                if ('before_migrate' in env):
-                    env.before_migrate(env, *args, **kwargs)
+            # before_migrate hook
+            if ('before_migrate' in env):
+                env.before_migrate(env, *args, **kwargs)
 
-                print(green('\nMigrating database.'))
-                utils.commands.django_manage(env.virtualenv_path, env.project_path, 'migrate')
-                print('')
+            print(green('\nMigrating database.'))
+            migrate_output = utils.commands.django_manage(env.virtualenv_path, env.project_path, 'migrate')
+            print('')
 
-            print(green('\nBacking up database at end.'))
-            utils.instance.backup_database(
-                os.path.join(env.backup_path, 'db_backup_end.sql')
-            )
-        except:
-            self.log(success=False)
+        # nothing applied, a rollback can keep the data written since this deploy
+        database_changed = (
+            utils.instance.is_database_changed_by(syncdb_output) or
+            utils.instance.is_database_changed_by(migrate_output, migrate=True)
+        )
+        if not database_changed and not [p for p in ['before_syncdb', 'before_migrate'] if p in pause_at or p in env]:
+            print(green('\nNo migrations were applied.'))
+            utils.instance.mark_database_unchanged(env.backup_path)
 
-            backup_file = os.path.join(env.backup_path, 'db_backup_start.sql')
+        print(green('\nBacking up database at end.'))
+        utils.instance.backup_database(
+            os.path.join(env.backup_path, 'db_backup_end.sql')
+        )
 
-            if exists(backup_file):
-                print(yellow('\nRestoring database.'))
-                utils.instance.restore_database(backup_file)
+    def database_changes_pending(self, pause_at):
+        """
+        Check if syncdb and migrate could change the database
 
-            print(green('\nRemoving this instance from filesystem.'))
-            utils.commands.delete(env.instance_path)
+            - always when `skip_unchanged_database` is off, or pauses or hooks are set around them
+            - when files matching `schema_pathspecs` changed since the current instance
+            - when `migrate --list` of the new instance shows unapplied migrations, if git can't tell
+        """
 
-            abort(red('Deploy failed and was rolled back.'))
+        if not env.skip_unchanged_database:
+            return True
+
+        if [p for p in ['before_syncdb', 'before_migrate'] if p in pause_at or p in env]:
+            return True
+
+        current_stamp = utils.instance.get_instance_stamp(env.current_instance_path)
+
+        # first deploy, or the current instance isn't a stamp
+        if not current_stamp or '/' in current_stamp:
+            return True
+
+        if utils.commands.remote_stamp_in_local_repo(current_stamp):
+            schema_changes = utils.source.get_schema_changes(current_stamp, self.stamp)
+
+            if schema_changes:
+                print('Database changes in %s.' % ', '.join(schema_changes))
+
+            return bool(schema_changes)
+
+        unapplied_migrations = utils.instance.get_unapplied_migrations(env.virtualenv_path, env.project_path)
+
+        if unapplied_migrations:
+            print('Unapplied migrations: %s.' % ', '.join(unapplied_migrations))
+
+        return bool(unapplied_migrations)
+
+    def restore_database_backup(self):
+        """ Restore database from snapshot or backup made at start of update_database, if any """
+
+        snapshot_name = utils.instance.find_database_snapshot(env.backup_path)
+
+        if snapshot_name:
+            print(yellow('\nRestoring database snapshot.'))
+            utils.instance.restore_database_snapshot(env.backup_path, snapshot_name)
+            return
+
+        backup_file = utils.instance.find_database_backup(os.path.join(env.backup_path, 'db_backup_start.sql'))
+
+        if backup_file:
+            print(yellow('\nRestoring database.'))
+            utils.instance.restore_database(backup_file)
+
+    def remove_instance(self, hosts):
+        """ Remove the new instance from the filesystem of every host """
+
+        for host in hosts:
+            with settings(host_string=host):
+                self.log(success=False)
+
+                print(yellow('\nRemoving this instance from filesystem.'))
+                utils.commands.delete(env.instance_path)
+
+    def switch_back(self, hosts):
+        """ Make the previous instance current again on hosts where the new instance was switched to """
+
+        for host in hosts:
+            with settings(host_string=host):
+                if utils.instance.get_instance_stamp(env.current_instance_path) == self.stamp:
+                    print(yellow('\nSwitching back to previous instance.'))
+                    with utils.commands.batch():
+                        utils.instance.rollback(env.vhost_path)
+                        utils.commands.touch_wsgi(env.vhost_path)
+
+    def before_restart(self, pause_at, *args, **kwargs):
 
         # before_restart pause
         if ('before_restart' in pause_at):
@@ -379,11 +720,15 @@ class Deployment(RemoteTask):
         if ('before_restart' in env):
             env.before_restart(env, *args, **kwargs)
 
-        print(green('\nUpdating instance symlinks.'))
-        utils.instance.set_current_instance(env.vhost_path, env.instance_path)
+    def switch_instance(self):
+        """ Make the new instance current and restart website """
 
-        print(green('\nRestarting website.'))
-        utils.commands.touch_wsgi(env.vhost_path)
+        print(green('\nUpdating instance symlinks and restarting website.'))
+        with utils.commands.batch():
+            utils.instance.set_current_instance(env.vhost_path, env.instance_path)
+            utils.commands.touch_wsgi(env.vhost_path)
+
+    def after_restart(self, pause_at, *args, **kwargs):
 
         # after_restart pause
         if ('after_restart' in pause_at):
@@ -394,50 +739,127 @@ class Deployment(RemoteTask):
         if ('after_restart' in env):
             env.after_restart(env, *args, **kwargs)
 
-        self.log(success=True)
+    def deploy_source(self, current_stamp):
+        """
+        Transfer source using the configured `source_transfer` method
+        Delta transfers fall back to a full archive if the current instance can't be used as base.
+        """
 
-        utils.instance.prune_obsolete_instances()
+        current_source_path = os.path.join(env.current_instance_path, env.project_name)
+
+        if env.source_transfer == 'delta':
+            if not current_stamp:
+                print(yellow('No current instance found, transferring full source.'))
+            elif not utils.commands.remote_stamp_in_local_repo(current_stamp):
+                print(yellow('Deployed commit is not in your local repository, transferring full source.'))
+            elif not utils.commands.path_exists(current_source_path):
+                print(yellow('No source found in current instance, transferring full source.'))
+            else:
+                utils.source.transfer_source_delta(
+                    upload_path=env.source_path,
+                    tree=self.stamp,
+                    previous_path=current_source_path,
+                    previous_tree=current_stamp
+                )
+                return
+
+        utils.source.transfer_source(upload_path=env.source_path, tree=self.stamp)
 
 
 class RemoveOldInstances(RemoteTask):
-    """ REMO - Remove old instances """
+    """
+    REMO - Remove old instances
+
+        Usage:
+
+        # also hardlink identical files of the remaining instances
+        $ fab staging remove_old_instances:dedup
+    """
     name = 'remove_old_instances'
 
     def __call__(self, *args, **kwargs):
-        utils.instance.prune_obsolete_instances()
+        utils.instance.prune_obsolete_instances(background=False)
+
+        if env.dedup_instances or 'dedup' in args:
+            utils.dedup.deduplicate_instances(env.vhost_path)
+
+        if env.shared_cache_path:
+            utils.instance.prune_shared_cache(env.shared_cache_path, env.shared_cache_size * 1024 * 1024)
+
+
+class PruneSharedCache(RemoteTask):
+    """ REMO - Remove least recently used entries from the shared cache of the host """
+    name = 'prune_shared_cache'
+
+    def __call__(self, *args, **kwargs):
+        if not env.shared_cache_path:
+            abort(red('No shared cache configured, see the `shared_cache_path` setting.'))
+
+        utils.instance.prune_shared_cache(env.shared_cache_path, env.shared_cache_size * 1024 * 1024)
 
 
 class Rollback(RemoteTask):
-    """ REMO - Rollback current instance to previous instance """
+    """
+    REMO - Rollback current instance to previous instance
+
+        Usage:
+
+        # restore the database only if the deploy of this instance changed it
+        $ fab staging rollback
+
+        # always restore the database to the start of this instance
+        $ fab staging rollback:restore
+    """
 
     name = 'rollback'
 
     def __call__(self, *args, **kwargs):
 
         # check if rollback is possible
-        if not exists(env.previous_instance_path):
+        if not utils.commands.path_exists(env.previous_instance_path):
             abort(red('No rollback possible. No previous instance found to rollback to.'))
-        if not exists(os.path.join(env.backup_path, 'db_backup_start.sql')):
-            abort(red('Could not find backupfile to restore database with.'))
+
+        # a parallel deploy updated the database from another host, its rollback restores the database
+        database_host = utils.instance.find_database_host(env.backup_path)
+
+        # deploy of this instance did not change the database, keep the data written since
+        backup_file = None
+        snapshot_name = None
+        if not database_host and ('restore' in args or not utils.instance.is_database_unchanged(env.backup_path)):
+            snapshot_name = utils.instance.find_database_snapshot(env.backup_path)
+            if not snapshot_name:
+                backup_file = utils.instance.find_database_backup(os.path.join(env.backup_path, 'db_backup_start.sql'))
+                if not backup_file:
+                    abort(red('Could not find backupfile to restore database with.'))
 
         # start rollback
         try:
-            print(green('\nRestoring database to start of this instance.'))
-            utils.instance.restore_database(
-                os.path.join(env.backup_path, 'db_backup_start.sql')
-            )
-
-            print(green('\nRemoving this instance and set previous to current.'))
-            utils.instance.rollback(env.vhost_path)
+            if snapshot_name:
+                print(green('\nRestoring database snapshot of start of this instance.'))
+                utils.instance.restore_database_snapshot(env.backup_path, snapshot_name)
+            elif backup_file:
+                print(green('\nRestoring database to start of this instance.'))
+                utils.instance.restore_database(backup_file)
+            elif database_host:
+                print(green('\nDatabase is restored by the rollback of %s, skipping restore.' % database_host))
+            else:
+                print(green('\nDatabase was not changed by this instance, skipping restore.'))
 
-            print(green('\nRestarting website.'))
-            utils.commands.touch_wsgi(env.vhost_path)
+            print(green('\nRemoving this instance, set previous to current and restarting website.'))
+            with utils.commands.batch():
+                utils.instance.rollback(env.vhost_path)
+                utils.commands.touch_wsgi(env.vhost_path)
 
             print(green('\nRemoving this instance from filesystem.'))
+            utils.instance.drop_database_snapshot(env.backup_path)
             utils.commands.delete(env.instance_path)
 
             self.log(success=True)
 
+        except SystemExit:
+            self.log(success=False)
+            raise
+
         except Exception, e:
             self.log(success=False)
             abort(red('Rollback failed: %s ' % e.message))
@@ -516,8 +938,12 @@ class Media(RemoteTask):
         file_name = 'project_media.tar'
         cwd = os.getcwd()
 
-        print(green('\nCompressing remote media folder.'))
-        utils.commands.create_tarball(env.vhost_path, 'media', file_name)  # TODO: media_path?
+        # tarball of an interrupted download is still on remote
+        if utils.transfer.get_partial_download(os.path.join(cwd, file_name)):
+            print(green('\nResuming download of media tarball.'))
+        else:
+            print(green('\nCompressing remote media folder.'))
+            utils.commands.create_tarball(env.vhost_path, 'media', file_name)  # TODO: media_path?
 
         print(green('\nDownloading tarball.'))
         utils.commands.download_file(
@@ -529,6 +955,38 @@ class Media(RemoteTask):
         print(os.path.join(cwd, file_name))
 
 
+class MediaSync(RemoteTask):
+    """
+    REMO - Sync media files, only missing or changed files are transferred
+
+        Usage:
+
+        # download remote media to `local_media_path`
+        $ fab staging media_sync
+
+        # upload local media to remote
+        $ fab staging media_sync:push
+
+        # compare files of equal size by checksum instead of modification time
+        $ fab staging media_sync:checksum
+    """
+
+    name = 'media_sync'
+
+    def __call__(self, *args, **kwargs):
+        push = 'push' in args
+
+        if push and not confirm(yellow('\nUpload local media files to %s?' % env.environment)):
+            abort(red('Aborted media sync.'))
+
+        utils.media.sync_media(
+            os.path.join(env.vhost_path, 'media'),
+            env.local_media_path,
+            push=push,
+            checksum='checksum' in args
+        )
+
+
 class Database(RemoteTask):
     """ REMO - Download database (as sqldump) """
 
@@ -546,9 +1004,16 @@ class RestoreDatabase(RemoteTask):
     name = 'restore_database'
 
     def __call__(self):
-        utils.instance.restore_database(
-            os.path.join(env.backup_path, 'db_backup_start.sql')
-        )
+        snapshot_name = utils.instance.find_database_snapshot(env.backup_path)
+        if snapshot_name:
+            utils.instance.restore_database_snapshot(env.backup_path, snapshot_name, keep=True)
+            return
+
+        backup_file = utils.instance.find_database_backup(os.path.join(env.backup_path, 'db_backup_start.sql'))
+        if not backup_file:
+            abort(red('Could not find backupfile to restore database with.'))
+
+        utils.instance.restore_database(backup_file)
 
 
 class Test(RemoteTask):
@@ -576,17 +1041,42 @@ class Test(RemoteTask):
 
 
 class RestoreRemoteDatabase(RemoteTask):
-    """ REMO - Restore remote database """
+    """
+    REMO - Restore remote database
+
+        Usage:
+
+        # pipe remote dump straight into local database
+        $ fab staging restore_remote_database
+
+        # download dump first and restore it from file
+        $ fab staging restore_remote_database:download
+
+        # restore the subset of rows selected by `database_subset`
+        $ fab staging restore_remote_database:subset
+    """
     name = 'restore_remote_database'
 
     def __call__(self, *args, **kwargs):
         settings = self.import_django_settings()
 
+        if 'download' not in args:
+            utils.instance.restore_remote_database_locally(settings, subset='subset' in args)
+            return
+
         local_backup_file = backup_and_download_database()
 
         print('Restoring database on local machine')
         database_operations = get_database_operations(env.database_engine)
-        database_operations.restore_local_database(local_backup_file, settings)
+        compressor = utils.compression.get_file_compressor(local_backup_file)
+        result = database_operations.restore_local_database(
+            local_backup_file,
+            settings,
+            decompress_command=compressor and utils.compression.decompress_command(compressor)
+        )
+
+        if result.failed:
+            abort(red('Could not restore %s on local machine.' % local_backup_file))
 
     def import_django_settings(self):
         sys.path.append(os.getcwd())
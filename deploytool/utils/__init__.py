@@ -1,3 +1,12 @@
+import artifacts
 import commands
+import compression
+import dedup
+import facts
 import instance
+import media
+import session
 import source
+import stream
+import transfer
+import wheelhouse
@@ -0,0 +1,120 @@
+import os
+import shutil
+import time
+
+from fabric.api import *
+from fabric.colors import *
+
+import commands
+
+
+def get_artifacts_path():
+    """ Returns local path of the artifact store, e.g. ~/.cache/deploytool """
+
+    return os.path.expanduser(env.artifact_cache_path)
+
+
+def lookup_artifact(key, name):
+    """
+    Returns local path to artifact `name` stored for `key` (e.g. a commit SHA1), or None
+    Using an artifact marks it as recently used.
+    """
+
+    key_path = os.path.join(get_artifacts_path(), key)
+    artifact_path = os.path.join(key_path, name)
+
+    if not os.path.exists(artifact_path):
+        return None
+
+    os.utime(key_path, None)
+    print('Using cached %s for %s.' % (name, key))
+
+    return artifact_path
+
+
+def store_artifact(key, name, file_path):
+    """
+    Moves file into the artifact store as `name` for `key`, and returns its new path
+    Evicts least recently used keys when the store exceeds `artifact_cache_size`.
+    """
+
+    key_path = os.path.join(get_artifacts_path(), key)
+    artifact_path = os.path.join(key_path, name)
+
+    if not os.path.exists(key_path):
+        os.makedirs(key_path)
+
+    # move into place atomically, concurrent deploys may store the same artifact
+    tmp_path = '%s.tmp-%d' % (artifact_path, os.getpid())
+    shutil.move(file_path, tmp_path)
+    os.rename(tmp_path, artifact_path)
+    os.utime(key_path, None)
+
+    prune_artifacts(env.artifact_cache_size * 1024 * 1024, keep=key)
+
+    return artifact_path
+
+
+def create_artifact(key, name, command):
+    """
+    Returns path to artifact `name` for `key`, creating it when missing
+    `command` is a local shell command with an `%(output)s` placeholder for the file to create.
+    """
+
+    artifact_path = lookup_artifact(key, name)
+
+    if artifact_path is None:
+        tmp_path = os.path.join(get_artifacts_path(), '.%s-%d' % (name, os.getpid()))
+
+        if not os.path.exists(get_artifacts_path()):
+            os.makedirs(get_artifacts_path())
+
+        if local(command % {'output': tmp_path}).failed:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            abort(red('Could not create %s for %s.' % (name, key)))
+
+        artifact_path = store_artifact(key, name, tmp_path)
+
+    return artifact_path
+
+
+def prune_artifacts(max_size, keep=None):
+    """ Remove least recently used keys until the artifact store fits in max_size bytes """
+
+    artifacts_path = get_artifacts_path()
+    if not os.path.exists(artifacts_path):
+        return
+
+    keys = []
+    total_size = 0
+
+    for key in os.listdir(artifacts_path):
+        key_path = os.path.join(artifacts_path, key)
+        if not os.path.isdir(key_path):
+            continue
+
+        size = 0
+        for root, folders, files in os.walk(key_path):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+
+        keys.append((os.path.getmtime(key_path), key, size))
+        total_size += size
+
+    # oldest first
+    keys.sort()
+
+    for last_used, key, size in keys:
+        if total_size <= max_size:
+            break
+        if key == keep:
+            continue
+
+        shutil.rmtree(os.path.join(artifacts_path, key), ignore_errors=True)
+        total_size -= size
+
+        print(yellow('Evicted cached artifacts for %s (%s, last used %s).' % (
+            key,
+            commands.format_size(size),
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used))
+        )))
@@ -1,9 +1,21 @@
 import os
+import posixpath
+from contextlib import contextmanager
 
 from fabric.api import *
 from fabric.colors import *
 from fabric.contrib.files import *
 
+import facts
+import transfer
+
+
+# operations queued by the active batch() block, as (cwd, command, description, paths) tuples
+_batch = None
+
+# remote path state per (host string, absolute path), only used inside a path_cache() block
+_path_cache = None
+
 
 def get_folder_size(path):
     """ Returns human-readable string with total recursive size of path """
@@ -11,6 +23,17 @@ def get_folder_size(path):
     return run('du -h --summarize %s' % path)
 
 
+def format_size(size):
+    """ Returns human-readable string for a size in bytes """
+
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return '%.1f %s' % (size, unit)
+        size = size / 1024.0
+
+    return '%.1f TB' % size
+
+
 def get_changed_files(local_stamp, remote_stamp, show_full_diff=False):
     """ Returns git diff from remote commit hash vs local HEAD commit hash """
 
@@ -35,6 +58,10 @@ def get_changed_files(local_stamp, remote_stamp, show_full_diff=False):
 def remote_stamp_in_local_repo(remote_stamp):
     """ Check if `remote_stamp` exists in local repository """
 
+    # without a commit git would check HEAD
+    if not remote_stamp:
+        return False
+
     return local('git branch --contains %s' % remote_stamp, capture=True)
 
 
@@ -46,11 +73,9 @@ def create_tarball(vhost_path, target, file_name='archive.tar'):
 
 
 def download_file(remote_path, local_path, delete_remote=True):
+    """ Download remote file in parallel chunks, resumable, the remote file is deleted once the download is verified """
 
-    get(remote_path, local_path)
-
-    if delete_remote:
-        delete(remote_path)
+    transfer.download_file(remote_path, local_path, delete_remote)
 
 
 def tail_file(file_path, lines=5):
@@ -59,47 +84,226 @@ def tail_file(file_path, lines=5):
     return run('tail --lines=%d %s' % (lines, file_path))
 
 
+@contextmanager
+def path_cache():
+    """
+    Cache results of path_exists() and read_link() for the duration of this block (e.g. a task run)
+
+    The helpers in this module forget the state of every path they change,
+    the cache is cleared when the outermost block ends.
+    """
+
+    global _path_cache
+
+    if _path_cache is not None:
+        yield
+        return
+
+    _path_cache = {}
+    try:
+        yield
+    finally:
+        _path_cache = None
+
+
+def _get_path_state(path):
+    """ Returns cached state dict of remote path, or a throwaway dict when not caching """
+
+    if _path_cache is None:
+        return {}
+
+    key = (env.host_string, posixpath.normpath(posixpath.join(env.cwd, path)))
+    return _path_cache.setdefault(key, {})
+
+
+def forget_path(path):
+    """ Remove cached state of remote path, of paths below it and of symbolic links pointing into it """
+
+    if not _path_cache:
+        return
+
+    path = posixpath.normpath(posixpath.join(env.cwd, path))
+
+    def is_affected(cached_path):
+        return cached_path == path or cached_path.startswith(path.rstrip('/') + '/')
+
+    for key, state in _path_cache.items():
+        if key[0] != env.host_string:
+            continue
+
+        if is_affected(key[1]) or is_affected(state.get('link') or ''):
+            del _path_cache[key]
+
+
+def path_exists(path):
+    """ Check if remote path exists """
+
+    state = _get_path_state(path)
+
+    if 'exists' not in state:
+        state['exists'] = exists(path)
+
+    return state['exists']
+
+
 def read_link(path):
     """ Returns real path for symbolic link """
 
-    if exists(path):
-        return run('readlink -f %s' % path).strip()
+    state = _get_path_state(path)
+
+    if 'link' not in state:
+        # a single command for both existence and link target
+        result = run('[ -e %s ] && readlink -f %s' % (path, path))
+
+        state['exists'] = result.succeeded
+        state['link'] = result.strip() if result.succeeded else ''
+
+    return state['link']
+
+
+@contextmanager
+def batch():
+    """
+    Queue the remote commands of helpers in this module and run them as a single remote script
+
+        with batch():
+            create_folder(instance_path)
+            create_folder(backup_path)
+
+    The script runs with `set -e`, so it stops at the first failing command and the deploy is aborted,
+    reporting which operation failed. Nested batches join the outer batch.
+    """
+
+    global _batch
+
+    if _batch is not None:
+        yield
+        return
+
+    _batch = []
+    try:
+        yield
+        operations = _batch
+    finally:
+        _batch = None
+
+    run_batch(operations)
+
+
+def run_batch(operations):
+    """ Run list of (cwd, command, description, paths) operations as a single remote script """
+
+    if not operations:
+        return
+
+    script = ['set -e']
+    current_cwd = ''
+
+    for index, (cwd, command, description, paths) in enumerate(operations):
+        if cwd != current_cwd:
+            script.append('cd %s' % (cwd or '~'))
+            current_cwd = cwd
+
+        script.append('echo "batch:%d"' % index)
+        script.append(command)
+
+    script.append('echo "batch:done"')
+
+    # batched commands carry their own cwd
+    with settings(cwd=''):
+        output = run('\n'.join(script))
+
+    for cwd, command, description, paths in operations:
+        with settings(cwd=cwd):
+            for path in paths:
+                forget_path(path)
+
+    lines = output.splitlines()
+    markers = [i for i, line in enumerate(lines) if line.strip().startswith('batch:')]
+
+    if not markers or lines[markers[-1]].strip() != 'batch:done':
+        failed_index = int(lines[markers[-1]].strip()[len('batch:'):]) if markers else 0
+        failed_output = '\n'.join(lines[markers[-1] + 1:]) if markers else output
+
+        abort(red('Could not %s.\n%s' % (operations[failed_index][2], failed_output)))
+
+
+def execute_operation(command, description, paths):
+    """ Run remote command changing paths, or queue it when inside a batch() block """
+
+    for path in paths:
+        forget_path(path)
+
+    if _batch is not None:
+        _batch.append((env.cwd, command, description, paths))
     else:
-        return ''
+        result = run(command)
+
+        for path in paths:
+            forget_path(path)
+
+        return result
 
 
 def create_folder(path):
 
-    if exists(path):
+    command = 'if [ -e %s ]; then echo "Path %s already exists."; exit 1; fi; mkdir %s' % (path, path, path)
+    result = execute_operation(command, 'create folder %s' % path, [path])
+
+    if result is not None and result.failed:
         abort(red('Path `%s` already exists.' % path))
-    else:
-        run('mkdir %s' % path)
 
 
 def delete(path):
 
-    run('rm -rf %s' % path)
+    return execute_operation('rm -rf %s' % path, 'delete %s' % path, [path])
 
 
 def create_symbolic_link(real_path, symbolic_path):
 
-    run('ln -sf %s %s' % (real_path, symbolic_path))
+    return execute_operation(
+        'ln -sf %s %s' % (real_path, symbolic_path),
+        'link %s to %s' % (symbolic_path, real_path),
+        [symbolic_path]
+    )
+
+
+def replace_symbolic_link(real_path, symbolic_path):
+    """ Point symbolic link to real_path by renaming a new link over it, so symbolic_path always resolves """
+
+    tmp_path = '%s.tmp' % symbolic_path.rstrip('/')
+
+    # `set -e` of a batch ignores failures on the left of &&, exit explicitly
+    return execute_operation(
+        'ln -sfn %s %s && mv -T %s %s || exit 1' % (real_path, tmp_path, tmp_path, symbolic_path),
+        'link %s to %s' % (symbolic_path, real_path),
+        [symbolic_path, tmp_path]
+    )
 
 
 def copy(from_path, to_path):
 
-    run('cp %s %s' % (from_path, to_path))
+    # replace instead of overwrite, the destination may be hardlinked to another instance
+    return execute_operation(
+        'cp --remove-destination %s %s' % (from_path, to_path),
+        'copy %s to %s' % (from_path, to_path),
+        [to_path]
+    )
+
 
+def rename(old_path, new_path, if_exists=False):
 
-def rename(old_path, new_path):
+    command = 'mv %s %s' % (old_path, new_path)
+    if if_exists:
+        command = 'if [ -e %s ]; then %s; fi' % (old_path, command)
 
-    run('mv %s %s' % (old_path, new_path))
+    return execute_operation(command, 'rename %s to %s' % (old_path, new_path), [old_path, new_path])
 
 
 def touch_wsgi(vhost_path):
     """ Touch WSGI to restart website """
 
-    return run('touch %s/django.wsgi' % vhost_path)
+    return execute_operation('touch %s/django.wsgi' % vhost_path, 'touch %s/django.wsgi' % vhost_path, [])
 
 
 def python_run(virtualenv_path, command):
@@ -114,7 +318,7 @@ def django_manage(virtualenv_path, project_path, command):
     python_path = os.path.join(project_path, 'manage.py')
     python_command = '%s %s' % (python_path, command)
 
-    python_run(virtualenv_path, python_command)
+    return python_run(virtualenv_path, python_command)
 
 
 def get_python_version():
@@ -122,6 +326,5 @@ def get_python_version():
     Return python version as <major>.<minor> string.
     E.g. '2.6'
     """
-    command = "python -c \"import sys;print '%s.%s' % (sys.version_info[0], sys.version_info[1])\""
 
-    return run(command)
\ No newline at end of file
+    return facts.get_host_facts()['python_version']
@@ -0,0 +1,129 @@
+from fabric.api import *
+from fabric.colors import *
+
+import facts
+
+
+COMPRESSORS = {
+    'gzip': {
+        'extension': '.gz',
+        'compress': 'gzip -c -%(level)d',
+        'decompress': 'gzip -dc',
+        'threaded_compress': 'pigz -c -%(level)d',
+        'level': 6,
+    },
+    'xz': {
+        'extension': '.xz',
+        'compress': 'xz -c -%(level)d',
+        'decompress': 'xz -dc',
+        'level': 6,
+    },
+    'zstd': {
+        'extension': '.zst',
+        'compress': 'zstd -c -q -%(level)d',
+        'decompress': 'zstd -dc -q',
+        'threaded_compress': 'zstd -c -q -T0 -%(level)d',
+        'level': 3,
+    },
+}
+
+# results of local `which` lookups
+_available = {}
+
+
+def compress_command(name, level=None):
+    """ Returns shell command compressing stdin to stdout """
+
+    compressor = COMPRESSORS[name]
+    return compressor['compress'] % {'level': level or compressor['level']}
+
+
+def threaded_compress_command(name, level=None):
+    """ Returns compress command using all processors of the remote host if possible (pigz, zstd -T0) """
+
+    compressor = COMPRESSORS[name]
+    threaded_command = compressor.get('threaded_compress')
+
+    if threaded_command and threaded_command.split()[0] in facts.get_host_facts()['commands']:
+        return threaded_command % {'level': level or compressor['level']}
+
+    return compress_command(name, level)
+
+
+def decompress_command(name):
+    """ Returns shell command decompressing stdin to stdout """
+
+    return COMPRESSORS[name]['decompress']
+
+
+def is_available(name, remote=True):
+    """ Check if compressor binary is available on remote (or local) machine """
+
+    binary = COMPRESSORS[name]['compress'].split()[0]
+
+    if remote:
+        return binary in facts.get_host_facts()['commands']
+
+    if binary not in _available:
+        with settings(hide('everything'), warn_only=True):
+            _available[binary] = local('which %s' % binary, capture=True).succeeded
+
+    return _available[binary]
+
+
+def negotiate(name):
+    """
+    Returns name of compressor to use for a transfer between local machine and remote
+    Falls back to gzip if the requested compressor is missing on either end, returns None for 'none'.
+    """
+
+    if not name or name == 'none':
+        return None
+
+    if name not in COMPRESSORS:
+        abort(red('Unknown compressor `%s`, use one of: none, %s' % (name, ', '.join(sorted(COMPRESSORS)))))
+
+    if name != 'gzip' and not (is_available(name, remote=False) and is_available(name, remote=True)):
+        print(yellow('Compressor `%s` is not available on both ends, using gzip.' % name))
+        return 'gzip'
+
+    return name
+
+
+def get_backup_compressor(download=False):
+    """
+    Returns name of compressor for database backups on remote host, or None for plain sql
+    'auto' prefers zstd and falls back to gzip. With download the compressor is needed on the local machine too.
+    """
+
+    name = env.backup_compression
+
+    if name == 'auto':
+        if is_available('zstd', remote=True) and (not download or is_available('zstd', remote=False)):
+            return 'zstd'
+        return 'gzip'
+
+    if download:
+        return negotiate(name)
+
+    if not name or name == 'none':
+        return None
+
+    if name not in COMPRESSORS:
+        abort(red('Unknown compressor `%s`, use one of: auto, none, %s' % (name, ', '.join(sorted(COMPRESSORS)))))
+
+    if name != 'gzip' and not is_available(name, remote=True):
+        print(yellow('Compressor `%s` is not available on remote, using gzip.' % name))
+        return 'gzip'
+
+    return name
+
+
+def get_file_compressor(file_path):
+    """ Returns name of compressor matching the extension of file_path, or None for an uncompressed file """
+
+    for name, compressor in COMPRESSORS.items():
+        if file_path.endswith(compressor['extension']):
+            return name
+
+    return None
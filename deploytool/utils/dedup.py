@@ -0,0 +1,108 @@
+from pipes import quote
+
+from fabric.api import *
+from fabric.colors import *
+
+import commands
+import stream
+
+
+# folders written to after the deploy, and compiled python files which are rewritten in place
+EXCLUDE = ['backup', 'media', '*.pyc', '*.pyo']
+
+# hardlinks identical files of all instances in the vhost (argv[1]), runs on python 2.6+ and 3
+DEDUP_SCRIPT = r'''
+import fnmatch, hashlib, os, re, stat, sys
+
+vhost_path = sys.argv[1]
+exclude = sys.argv[2:]
+
+def excluded(name):
+    for pattern in exclude:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+def digest(path):
+    checksum = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            chunk = f.read(1048576)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    finally:
+        f.close()
+    return checksum.hexdigest()
+
+# candidates share size, permissions and owner, they would share them after linking
+candidates = {}
+for name in sorted(os.listdir(vhost_path)):
+    root = os.path.join(vhost_path, name)
+    if not re.match("^[0-9a-f]{40}$", name) or os.path.islink(root) or not os.path.isdir(root):
+        continue
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not excluded(d)]
+        for filename in filenames:
+            if excluded(filename):
+                continue
+            path = os.path.join(dirpath, filename)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                key = (st.st_size, st.st_mode, st.st_uid, st.st_gid, st.st_dev)
+                candidates.setdefault(key, []).append((path, st.st_ino, st.st_nlink))
+
+linked_files = 0
+reclaimed_bytes = 0
+
+for key, files in candidates.items():
+    if len(set([f[1] for f in files])) < 2:
+        continue
+
+    inode_digests = {}
+    groups = {}
+    for path, inode, nlink in files:
+        if inode not in inode_digests:
+            inode_digests[inode] = digest(path)
+        groups.setdefault(inode_digests[inode], []).append((path, inode, nlink))
+
+    for group in groups.values():
+        # link to the inode with most links already
+        target_path, target_inode, target_nlink = max(group, key=lambda f: f[2])
+        replaced = {}
+        for path, inode, nlink in group:
+            if inode == target_inode:
+                continue
+            tmp_path = "%s.dedup-tmp" % path
+            os.link(target_path, tmp_path)
+            os.rename(tmp_path, path)
+            linked_files += 1
+            replaced[inode] = replaced.get(inode, 0) + 1
+            if replaced[inode] == nlink:
+                reclaimed_bytes += key[0]
+
+sys.stdout.write("dedup:%d %d\n" % (linked_files, reclaimed_bytes))
+'''
+
+
+def deduplicate_instances(vhost_path):
+    """
+    Replace identical files of all instances in vhost_path with hardlinks to one of them
+    Files are compared by content hash, backups, media and compiled python files are never touched.
+    """
+
+    print(green('\nHardlinking identical files of instances.'))
+
+    output = stream.remote_output(
+        'python - %s %s' % (quote(vhost_path), ' '.join(quote(e) for e in EXCLUDE)),
+        DEDUP_SCRIPT
+    )
+
+    result = [l for l in output.splitlines() if l.startswith('dedup:')]
+    linked_files, reclaimed_bytes = [int(n) for n in result[-1][len('dedup:'):].split()]
+
+    print('Linked %d files, reclaimed %s.' % (linked_files, commands.format_size(reclaimed_bytes)))
+
+    # paths were replaced behind the back of the path cache
+    commands.forget_path(vhost_path)
@@ -0,0 +1,104 @@
+import json
+import os
+
+from fabric.api import *
+from fabric.colors import *
+
+
+# binaries looked up with `which`, available ones end up in the `commands` fact
+COMMANDS = [
+    'apachectl',
+    'gzip',
+    'mydumper',
+    'myloader',
+    'pg_dump',
+    'pg_restore',
+    'pigz',
+    'xz',
+    'zstd',
+]
+
+# every fact is printed as `fact:<name>=<value>` on a single line
+FACTS_SCRIPT = r'''
+echo "fact:python_version=$(python -c 'import sys; sys.stdout.write("%%d.%%d" %% sys.version_info[:2])' 2>&1)"
+echo "fact:python_full_version=$(python -V 2>&1)"
+echo "fact:os_release=$(cat /etc/redhat-release 2>/dev/null || (. /etc/os-release 2>/dev/null && echo $PRETTY_NAME))"
+echo "fact:cpu_count=$(nproc 2>/dev/null || grep -c ^processor /proc/cpuinfo)"
+echo "fact:free_disk=$(df -Pk %(vhosts_path)s | awk 'NR==2 { print $4 }')"
+echo "fact:credentials=$(cat %(credentials_file)s 2>/dev/null | tr '\n' ' ')"
+for p in /etc/httpd/conf.d /etc/apache2/conf.d; do [ -e $p ] && echo "fact:apache_conf_path=$p" && break; done
+for p in /etc/init.d/httpd /etc/init.d/apache2; do [ -e $p ] && echo "fact:apache_daemon=$p" && break; done
+for c in %(commands)s; do which $c >/dev/null 2>&1 && echo "fact:command=$c"; done
+true
+'''
+
+# facts per host string and vhost, cached for the rest of the Fabric session
+# environments sharing a host (e.g. staging and live) have their own vhost and credentials
+_facts = {}
+
+
+def get_host_facts(refresh=False):
+    """
+    Returns dict with facts about the current host and vhost, gathered in a single remote command
+
+        python_version          e.g. '2.6'
+        python_full_version     e.g. 'Python 2.6.6'
+        os_release              e.g. 'CentOS release 6.4 (Final)'
+        cpu_count               number of processors
+        free_disk               free bytes on the vhosts filesystem
+        credentials             parsed credentials.json of the project, or None
+        apache_conf_path        /etc/httpd/conf.d (CentOS) or /etc/apache2/conf.d (Ubuntu), or None
+        apache_daemon           /etc/init.d/httpd (CentOS) or /etc/init.d/apache2 (Ubuntu), or None
+        commands                list of available binaries (see COMMANDS)
+
+    The facts are also available as `env.host_facts`.
+    """
+
+    key = (env.host_string, env.vhost_path)
+
+    if refresh or key not in _facts:
+        script = FACTS_SCRIPT % {
+            'vhosts_path': env.vhosts_path,
+            'credentials_file': os.path.join(env.vhost_path, 'credentials.json'),
+            'commands': ' '.join(COMMANDS),
+        }
+
+        with settings(hide('running', 'stdout')):
+            output = run(script)
+
+        facts = {
+            'apache_conf_path': None,
+            'apache_daemon': None,
+            'commands': [],
+        }
+
+        for line in output.splitlines():
+            if not line.startswith('fact:') or '=' not in line:
+                continue
+
+            name, value = line[len('fact:'):].split('=', 1)
+            value = value.strip()
+
+            if name == 'command':
+                facts['commands'].append(value)
+            else:
+                facts[name] = value
+
+        facts['cpu_count'] = int(facts.get('cpu_count') or 1)
+        facts['free_disk'] = int(facts.get('free_disk') or 0) * 1024
+
+        try:
+            facts['credentials'] = json.loads(facts.get('credentials') or 'null')
+        except ValueError:
+            facts['credentials'] = None
+
+        _facts[key] = facts
+
+    env.host_facts = _facts[key]
+    return env.host_facts
+
+
+def forget_host_facts():
+    """ Remove cached facts for the current host, e.g. after changing files they are based on """
+
+    _facts.pop((env.host_string, env.vhost_path), None)
@@ -1,60 +1,259 @@
 from datetime import datetime
-import uuid
 import os
-import json
+from pipes import quote
 
 from fabric.api import *
 from fabric.colors import *
 from fabric.contrib.files import *
 
 from deploytool.db import get_database_operations
+from deploytool.db.subset import get_subset_dump_command
 
 import commands
+import compression
+import facts
+import stream
+import transfer
+
+
+# lists instances newest first with their disk usage, plus current/previous links and database snapshots
+# a single du call counts files hardlinked between instances once, for the newest instance holding them
+INSTANCES_SCRIPT = r'''
+cd %(vhost_path)s || exit 1
+echo "current:$(readlink current_instance)"
+echo "previous:$(readlink previous_instance)"
+instances=$(ls -1tcd */ 2>/dev/null | awk '{ if(length($1) == 41) { print substr($1, 1, 40) }}')
+[ -n "$instances" ] && du -sk $instances | sed 's/^/instance:/'
+for i in $instances; do [ -f $i/backup/database_snapshot ] && echo "snapshot:$i $(cat $i/backup/database_snapshot)"; done
+true
+'''
 
 
 def get_obsolete_instances(vhost_path):
-    """ Return obsolete instances from remote server """
+    """
+    Returns list of (instance, database snapshot or None) to remove from remote server, oldest first
 
-    try:
-        with cd(vhost_path):
+    Everything but the `keep_instances` newest instances is obsolete, and with `instance_disk_budget` the oldest
+    instances are obsolete until the rest fits in the budget. The current and previous instance are always kept.
+    """
 
-            # list directories, display name only, sort by ctime, filter by git-commit-tag-length
-            command = 'ls -1tcd */ | awk \'{ if(length($1) == 41) { print $1 }}\''
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run(INSTANCES_SCRIPT % {'vhost_path': vhost_path})
 
-            # split into list and return everything but the 3 newest instances
-            return run(command).split()[3:]
-    except:
+    if output.failed:
         return []
 
+    protected = []
+    instances = []
+    sizes = {}
+    snapshots = {}
+
+    for line in output.splitlines():
+        name, _, value = line.strip().partition(':')
+
+        if name in ('current', 'previous'):
+            protected.append(value.strip()[-40:])
+        elif name == 'instance':
+            size, instance = value.split()
+            instances.append(instance)
+            sizes[instance] = int(size) * 1024
+        elif name == 'snapshot':
+            instance, snapshot_name = value.split()
+            snapshots[instance] = snapshot_name
+
+    total_size = sum(sizes.values())
+    budget = env.instance_disk_budget * 1024 * 1024 if env.instance_disk_budget else None
+
+    obsolete_instances = []
+
+    # instances are listed newest first, so the index is the number of newer instances
+    for index in reversed(range(len(instances))):
+        instance = instances[index]
+
+        if instance in protected:
+            continue
+
+        over_count = env.keep_instances is not None and index >= env.keep_instances
+        over_budget = budget is not None and total_size > budget
+
+        if over_count or over_budget:
+            obsolete_instances.append((instance, snapshots.get(instance)))
+            total_size -= sizes[instance]
+
+    if budget is not None and total_size > budget:
+        print(yellow('Instances use %s, which is more than the disk budget of %s.' % (
+            commands.format_size(total_size),
+            commands.format_size(budget)
+        )))
 
-def prune_obsolete_instances():
-    """ Find old instances and remove them to free up space """
+    return obsolete_instances
+
+
+def prune_obsolete_instances(background=None):
+    """
+    Find old instances and remove them to free up space, in a single remote command
+    With background (defaults to `prune_in_background`) the files are removed after returning.
+    """
+
+    obsolete_instances = get_obsolete_instances(env.vhost_path)
+
+    if not obsolete_instances:
+        return
+
+    if background is None:
+        background = env.prune_in_background
 
     removed_instances = []
+    instance_paths = []
+
+    for instance, snapshot_name in obsolete_instances:
+        if snapshot_name:
+            drop_database_snapshot(os.path.join(env.vhost_path, instance, 'backup'), snapshot_name)
 
-    for instance in get_obsolete_instances(env.vhost_path):
-        is_current = bool(get_instance_stamp(env.current_instance_path) == instance)
-        is_previous = bool(get_instance_stamp(env.previous_instance_path) == instance)
+        removed_instances.append(instance)
+        instance_paths.append(os.path.join(env.vhost_path, instance))
 
-        if not (is_current or is_previous):
-            commands.delete(os.path.join(env.vhost_path, instance))
-            removed_instances.append(instance)
+    if background:
+        # without a pty the removal survives the end of the ssh session
+        with settings(hide('running', 'stdout')):
+            run('nohup rm -rf %s > /dev/null 2>&1 &' % ' '.join(instance_paths), pty=False)
+
+        for path in instance_paths:
+            commands.forget_path(path)
+
+        print(green('\nThese old instances are being removed from remote filesystem:'))
+    else:
+        with commands.batch():
+            for path in instance_paths:
+                commands.delete(path)
 
-    if removed_instances:
         print(green('\nThese old instances were removed from remote filesystem:'))
-        print(removed_instances)
 
+    print(removed_instances)
+
+
+# estimates the disk usage of a new instance from the current instance
+INSTANCE_SIZE_SCRIPT = r'''
+du -sk %(current_instance_path)s/env %(current_instance_path)s/backup/db_backup_*.sql* 2>/dev/null
+true
+'''
+
+
+def estimate_instance_size(source_size):
+    """
+    Returns bytes needed on remote server for a new instance, estimated with a single remote command
+    That is the source, a virtualenv as big as the current one and two database dumps as big as the last one.
+    """
+
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run(INSTANCE_SIZE_SCRIPT % {'current_instance_path': env.current_instance_path})
+
+    virtualenv_size = 0
+    dump_size = 0
+
+    for line in output.splitlines():
+        fields = line.split()
+
+        if len(fields) != 2 or not fields[0].isdigit():
+            continue
+
+        size = int(fields[0]) * 1024
+
+        if fields[1].endswith('/env'):
+            virtualenv_size = size
+        else:
+            dump_size = max(dump_size, size)
+
+    return source_size + virtualenv_size + 2 * dump_size
+
+
+# extension of backups made with the parallel dump tools, these are directories
+PARALLEL_BACKUP_EXTENSION = '.dir'
+
+
+def get_database_workers():
+    """ Returns number of parallel database dump and restore workers, defaults to the processors of the host """
+
+    return env.database_workers or facts.get_host_facts()['cpu_count']
+
+
+def use_parallel_backup(database_operations):
+    """ Check if backups are made with the parallel dump tools, falls back to plain sql when they are missing """
+
+    if env.backup_format != 'parallel':
+        return False
+
+    missing = [c for c in database_operations.parallel_commands if c not in facts.get_host_facts()['commands']]
+
+    if missing:
+        print(yellow('Parallel backup needs %s on remote, using plain sql.' % ', '.join(missing)))
+        return False
+
+    return True
+
+
+def backup_database(file_path, download=False):
+    """
+    Dump database to file_path, compressed with `backup_compression` on the remote host
+    Returns path of the backup, which has the extension of the compressor appended.
+    With `backup_format` 'parallel' the backup is a directory dumped by one worker per processor,
+    except when it is downloaded.
+    """
 
-def backup_database(file_path):
     database_operations = get_database_operations(env.database_engine)
     credentials = get_database_credentials()
 
-    database_operations.backup_database(
+    if not download and use_parallel_backup(database_operations):
+        backup_path = file_path + PARALLEL_BACKUP_EXTENSION
+
+        result = database_operations.backup_database_parallel(
+            credentials['database'],
+            credentials['username'],
+            credentials['password'],
+            backup_path,
+            get_database_workers()
+        )
+        check_database_backup(result, backup_path)
+
+        return backup_path
+
+    compressor = compression.get_backup_compressor(download)
+    compress_command = None
+
+    if compressor:
+        file_path += compression.COMPRESSORS[compressor]['extension']
+        compress_command = compression.threaded_compress_command(compressor, env.backup_compression_level)
+
+    result = database_operations.backup_database(
         credentials['database'],
         credentials['username'],
         credentials['password'],
-        file_path
+        file_path,
+        compress_command=compress_command
     )
+    check_database_backup(result, file_path)
+
+    return file_path
+
+
+def check_database_backup(result, backup_path):
+    """ Abort when the backup failed, the incomplete backup is removed so it is never restored """
+
+    if result.failed:
+        run('rm -rf %s' % backup_path)
+        abort(red('Could not back up database to %s.' % backup_path))
+
+
+def find_database_backup(file_path):
+    """ Returns path of the (compressed) backup made with backup_database(file_path), or None """
+
+    candidates = [file_path + compression.COMPRESSORS[name]['extension'] for name in sorted(compression.COMPRESSORS)]
+    candidates.extend([file_path + PARALLEL_BACKUP_EXTENSION, file_path])
+
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run('for f in %s; do [ -e "$f" ] && echo "$f" && break; done; true' % ' '.join(candidates))
+
+    return output.strip() or None
 
 
 def restore_database(file_path):
@@ -63,15 +262,225 @@ def restore_database(file_path):
     database_operations = get_database_operations(env.database_engine)
     credentials = get_database_credentials()
 
-    database_operations.restore_database(
+    if file_path.endswith(PARALLEL_BACKUP_EXTENSION):
+        result = database_operations.restore_database_parallel(
+            credentials['database'],
+            credentials['username'],
+            credentials['password'],
+            file_path,
+            get_database_workers()
+        )
+    else:
+        compressor = compression.get_file_compressor(file_path)
+
+        result = database_operations.restore_database(
+            credentials['database'],
+            credentials['username'],
+            credentials['password'],
+            file_path,
+            decompress_command=compressor and compression.decompress_command(compressor)
+        )
+
+    if result.failed:
+        abort(red('Could not restore database from %s.' % file_path))
+
+
+def snapshot_database(backup_path):
+    """
+    Copy database to a snapshot named after the instance, the name is recorded in backup_path
+    Returns False when the snapshot failed, nothing is recorded then.
+    """
+
+    database_operations = get_database_operations(env.database_engine)
+    credentials = get_database_credentials()
+    snapshot_name = '%s_snapshot_%s' % (credentials['database'], env.instance_stamp[:10])
+
+    result = database_operations.create_snapshot(
+        credentials['database'],
+        credentials['username'],
+        credentials['password'],
+        snapshot_name
+    )
+
+    if result.failed:
+        database_operations.drop_snapshot(
+            credentials['database'],
+            credentials['username'],
+            credentials['password'],
+            snapshot_name
+        )
+        return False
+
+    run('echo %s > %s' % (snapshot_name, os.path.join(backup_path, 'database_snapshot')))
+    return True
+
+
+def find_database_snapshot(backup_path):
+    """ Returns name of the database snapshot recorded in backup_path, or None """
+
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run('cat %s 2>/dev/null' % os.path.join(backup_path, 'database_snapshot'))
+
+    return output.succeeded and output.strip() or None
+
+
+def restore_database_snapshot(backup_path, snapshot_name, keep=False):
+    """ Swap database with its snapshot in constant time, with keep a new snapshot is copied from the result """
+
+    database_operations = get_database_operations(env.database_engine)
+    credentials = get_database_credentials()
+
+    database_operations.restore_snapshot(
         credentials['database'],
         credentials['username'],
         credentials['password'],
-        file_path
+        snapshot_name
     )
 
+    run('rm -f %s' % os.path.join(backup_path, 'database_snapshot'))
+
+    # the restored database is the start of the instance, back it up when it can't be snapshot for a later rollback
+    if keep and not snapshot_database(backup_path):
+        print(yellow('Could not snapshot database again, making a backup instead.'))
+        backup_database(os.path.join(backup_path, 'db_backup_start.sql'))
+
+
+def drop_database_snapshot(backup_path, snapshot_name=None):
+    """ Drop database snapshot recorded in backup_path, if any, pass snapshot_name when it is already known """
+
+    snapshot_name = snapshot_name or find_database_snapshot(backup_path)
+
+    if snapshot_name:
+        database_operations = get_database_operations(env.database_engine)
+        credentials = get_database_credentials()
+
+        database_operations.drop_snapshot(
+            credentials['database'],
+            credentials['username'],
+            credentials['password'],
+            snapshot_name
+        )
+
+
+def get_unapplied_migrations(virtualenv_path, project_path):
+    """ Returns list of unapplied migrations reported by `migrate --list`, e.g. ['blog: 0002_add_tags'] """
+
+    with settings(hide('running', 'stdout')):
+        output = commands.django_manage(virtualenv_path, project_path, 'migrate --list')
+
+    if output.failed:
+        abort(red('Could not list migrations.\n%s' % output))
+
+    unapplied = []
+    app = None
+
+    for line in output.splitlines():
+        if not line.startswith(' '):
+            app = line.strip()
+
+        # South lists unapplied migrations as ` ( ) 0002_name`, Django as ` [ ] 0002_name`
+        elif line.strip()[:3] in ('( )', '[ ]'):
+            unapplied.append('%s: %s' % (app, line.strip()[3:].strip()))
+
+    return unapplied
+
+
+def is_database_changed_by(output, migrate=False):
+    """
+    Check if syncdb or (with migrate) migrate output shows the database was changed
+
+        syncdb      'Creating table blog_post', 'Installed 3 object(s) from 1 fixture(s)'
+        South       ' > blog:0002_add_tags', migrate only, syncdb lists synced apps as ' > blog'
+        Django      '  Applying blog.0002_add_tags... OK'
+    """
+
+    for line in output.splitlines():
+        line = line.strip()
+
+        if line.startswith('Creating table ') or line.startswith('Applying '):
+            return True
+        if migrate and line.startswith('> ') and ':' in line:
+            return True
+        if line.startswith('Installed ') and not line.startswith('Installed 0 '):
+            return True
+
+    return False
+
+
+def mark_database_unchanged(backup_path):
+    """ Record in backup_path that the deploy did not touch the database, so rollback needs no restore """
+
+    run('touch %s' % os.path.join(backup_path, 'database_unchanged'))
+
+
+def mark_database_host(backup_path, host):
+    """ Record in backup_path that the database of the deploy was updated (and backed up) from host """
+
+    run('echo %s > %s' % (quote(host), os.path.join(backup_path, 'database_host')))
+
+
+def find_database_host(backup_path):
+    """ Returns host recorded in backup_path by a parallel deploy that holds the database backups, or None """
+
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run('cat %s 2>/dev/null' % os.path.join(backup_path, 'database_host'))
+
+    return output.succeeded and output.strip() or None
+
+
+def is_database_unchanged(backup_path):
+    """ Check if the deploy of the instance of backup_path did not touch the database """
+
+    return commands.path_exists(os.path.join(backup_path, 'database_unchanged'))
+
+
+def get_download_dump_command(subset=False):
+    """
+    Returns tuple of (remote command writing database dump to stdout, compressor used or None)
+    With subset only the rows selected by `database_subset` are dumped.
+    """
+
+    database_operations = get_database_operations(env.database_engine)
+    credentials = get_database_credentials()
+
+    if subset:
+        if not env.database_subset:
+            abort(red('Set `database_subset` to dump a subset of the database.'))
+
+        remote_command = get_subset_dump_command(
+            database_operations,
+            credentials['database'],
+            credentials['username'],
+            credentials['password'],
+            env.database_subset
+        )
+    else:
+        remote_command = database_operations.dump_command(
+            credentials['database'],
+            credentials['username'],
+            credentials['password']
+        )
+
+    compressor = compression.get_backup_compressor(download=True)
+
+    if compressor:
+        remote_command = '%s | %s' % (
+            remote_command,
+            compression.threaded_compress_command(compressor, env.backup_compression_level)
+        )
+
+    return remote_command, compressor
+
 
 def backup_and_download_database(local_output_filename=''):
+    """
+    Download (compressed) database dump from remote into a local file, returns path of the local file
+
+        stream      dumping and downloading overlap, the dump is never written to disk on the remote
+        chunked     the dump is written on the remote and downloaded in parallel chunks, running the task
+                    again with the same output filename resumes an interrupted download
+    """
+
     def generate_output_file():
         timestamp = datetime.today().strftime('%y%m%d%H%M')
         return '%s%s_%s.sql' % (env.project_name_prefix, env.database_name, timestamp)
@@ -79,13 +488,31 @@ def backup_and_download_database(local_output_filename=''):
     if not local_output_filename:
         local_output_filename = generate_output_file()
 
-    remote_filename = os.path.join(env.backup_path, str(uuid.uuid4()))
+    remote_filename = os.path.join(env.backup_path, 'download_%s' % os.path.basename(local_output_filename))
+    compressor = compression.get_backup_compressor(download=True)
+
+    if compressor:
+        if compression.get_file_compressor(local_output_filename) != compressor:
+            local_output_filename += compression.COMPRESSORS[compressor]['extension']
+
+    if env.download_method == 'chunked':
+        partial_download = transfer.get_partial_download(local_output_filename)
+
+        if partial_download:
+            print(green('\nResuming download of backup.'))
+        else:
+            print(green('\nCreating backup.'))
+            partial_download = backup_database(remote_filename, download=True)
+
+        print(green('\nDownloading and removing remote backup.'))
+        commands.download_file(partial_download, local_output_filename)
+
+        return os.path.join(os.getcwd(), local_output_filename)
 
-    print(green('\nCreating backup.'))
-    backup_database(remote_filename)
+    remote_command, compressor = get_download_dump_command()
 
-    print(green('\nDownloading and removing remote backup.'))
-    commands.download_file(remote_filename, local_output_filename)
+    print(green('\nStreaming backup.'))
+    stream.download_stream(remote_command, local_output_filename)
 
     return os.path.join(os.getcwd(), local_output_filename)
 
@@ -96,8 +523,11 @@ def create_virtualenv(virtualenv_path):
     run('virtualenv %s --no-site-packages' % virtualenv_path)
 
 
-def pip_install_requirements(virtualenv_path, requirements_path, cache_path, log_path):
-    """ Requires availability of Pip (0.8.1 or later) on remote system """
+def pip_install_requirements(virtualenv_path, requirements_path, cache_path, log_path, wheelhouse_path=None):
+    """
+    Requires availability of Pip (0.8.1 or later) on remote system
+    With a wheelhouse, packages are only installed from its wheels (requires Pip 1.4 or later)
+    """
 
     requirements_file = os.path.join(requirements_path, 'requirements.txt')
     log_file = os.path.join(log_path, 'pip.log')
@@ -105,8 +535,113 @@ def pip_install_requirements(virtualenv_path, requirements_path, cache_path, log
     if not exists(requirements_file) or not exists(virtualenv_path):
         abort(red('Could not install packages. Virtual environment or requirements.txt not found.'))
 
+    if wheelhouse_path:
+        args = (virtualenv_path, requirements_file, wheelhouse_path, log_file)
+        return run('%s/bin/pip install -r %s --no-index --find-links=%s --quiet --log=%s' % args)
+
     args = (virtualenv_path, requirements_file, cache_path, log_file)
-    run('%s/bin/pip install -r %s --download-cache=%s --use-mirrors --quiet --log=%s' % args)
+    return run('%s/bin/pip install -r %s --download-cache=%s --use-mirrors --quiet --log=%s' % args)
+
+
+def is_shared_cache_writable(shared_cache_path):
+    """ Check if the project user can add to the shared cache, which only exists once `setup_shared_cache` ran """
+
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        return run('[ -w %s ] && [ -w %s ]' % (
+            os.path.join(shared_cache_path, 'download'),
+            os.path.join(shared_cache_path, 'wheels')
+        )).succeeded
+
+
+def prune_shared_cache(shared_cache_path, max_size):
+    """
+    Remove least recently used downloads and wheelhouses until shared cache fits in max_size bytes
+    Wheelhouses are removed as a whole, they are touched on every use. Pip only reads downloads,
+    so their last use is the access time (updated daily with the default relatime mount option).
+    """
+
+    with cd(shared_cache_path):
+        # <atime> <mtime> <size in KB> <path>
+        output = run('for f in download/* wheels/*; do [ -e "$f" ] && echo "$(stat -c "%X %Y" "$f") $(du -sk "$f")"; done')
+
+    entries = []
+    total_size = 0
+
+    for line in output.splitlines():
+        fields = line.split(None, 3)
+        if len(fields) != 4 or not fields[0].isdigit() or not fields[1].isdigit():
+            continue
+
+        # mtime as well, for filesystems mounted with noatime
+        last_used = max(int(fields[0]), int(fields[1]))
+        size = int(fields[2]) * 1024
+        entries.append((last_used, size, fields[3]))
+        total_size += size
+
+    # oldest first
+    entries.sort()
+    obsolete_entries = []
+
+    for last_used, size, path in entries:
+        if total_size <= max_size:
+            break
+
+        obsolete_entries.append(path)
+        total_size -= size
+
+    if obsolete_entries:
+        with cd(shared_cache_path):
+            run('rm -rf %s' % ' '.join(obsolete_entries))
+
+        print(green('\nThese entries were removed from the shared cache:'))
+        print(obsolete_entries)
+
+    print('Shared cache is %s.' % commands.format_size(total_size))
+
+
+def get_requirements_hash(requirements_path):
+    """ Returns hash of requirements.txt, .pth files and remote python version """
+
+    with cd(requirements_path):
+        return run('(cat requirements.txt; cat *.pth 2>/dev/null; python -V 2>&1) | sha1sum | cut -d " " -f 1').strip()
+
+
+def read_requirements_hash(virtualenv_path):
+    """ Returns requirements hash recorded in virtual environment, or an empty string """
+
+    hash_file = os.path.join(virtualenv_path, '.requirements_hash')
+
+    if exists(hash_file):
+        return run('cat %s' % hash_file).strip()
+    else:
+        return ''
+
+
+def write_requirements_hash(virtualenv_path, requirements_hash):
+    """ Record requirements hash in virtual environment, for reuse by later instances """
+
+    run('echo %s > %s' % (requirements_hash, os.path.join(virtualenv_path, '.requirements_hash')))
+
+
+def clone_virtualenv(from_path, to_path):
+    """
+    Copy virtual environment using hardlinks
+    Absolute paths in activate scripts, shebangs, .pth files and symbolic links are changed to the new location,
+    `sed -i` and `ln -sfn` replace those files, so the original environment is left untouched.
+    """
+
+    run('cp -al %s/. %s' % (from_path, to_path))
+    run('grep -rlIF --null %(from)s %(to)s | xargs -0 -r sed -i "s#%(from)s#%(to)s#g"' % {
+        'from': from_path,
+        'to': to_path,
+    })
+
+    # grep doesn't follow links, e.g. the absolute env/local/* links of Debian's virtualenv
+    run('find %(to)s -type l -lname "%(from)s/*" | while read link; do '
+        'ln -sfn "$(readlink "$link" | sed "s#^%(from)s#%(to)s#")" "$link"; done' % {
+            'from': from_path,
+            'to': to_path,
+        })
 
 
 def get_instance_stamp(instance_path):
@@ -116,36 +651,62 @@ def get_instance_stamp(instance_path):
 
 
 def set_current_instance(vhost_path, instance_path):
-    """ Delete previous, set current to previous and new to current """
+    """
+    Set current to previous and new to current
+    Both links are replaced by renaming a new link over them, in a single remote step, so they never dangle.
+    """
 
     with cd(vhost_path):
-        commands.delete('./previous_instance')
+        current_path = commands.read_link('./current_instance')
 
-        if exists('./current_instance'):
-            commands.rename('./current_instance', './previous_instance')
-
-        commands.create_symbolic_link(instance_path, './current_instance')
+        with commands.batch():
+            if current_path:
+                commands.replace_symbolic_link(current_path, './previous_instance')
+            commands.replace_symbolic_link(instance_path, './current_instance')
 
 
 def rollback(vhost_path):
-    """ Updates symlinks: Remove current instance and rename previous to current """
+    """ Updates symlinks: Replace current instance with previous and remove previous """
 
     with cd(vhost_path):
-        if exists('./previous_instance'):
-            commands.delete('./current_instance')
-            commands.rename('./previous_instance', './current_instance')
+        previous_path = commands.read_link('./previous_instance')
 
+        if previous_path:
+            with commands.batch():
+                commands.replace_symbolic_link(previous_path, './current_instance')
+                commands.delete('./previous_instance')
 
-def get_database_credentials():
-    credentials_filename = 'credentials.json'
 
-    get(
-        os.path.join(env.vhost_path, credentials_filename),
-        credentials_filename
-    )
+def get_database_credentials():
+    credentials = facts.get_host_facts()['credentials']
 
-    with open(credentials_filename) as f:
-        credentials = json.load(f)
+    if not credentials:
+        abort(red('Could not read %s.' % os.path.join(env.vhost_path, 'credentials.json')))
 
-    os.remove(credentials_filename)
     return credentials
+
+
+def restore_remote_database_locally(django_settings, subset=False):
+    """
+    Restore local database while the remote dump streams in, nothing is written to disk on either side
+    Dumping, transferring and restoring overlap.
+    """
+
+    database_operations = get_database_operations(env.database_engine)
+    remote_command, compressor = get_download_dump_command(subset)
+
+    local_command = database_operations.local_restore_command(django_settings)
+    if compressor:
+        local_command = 'bash -c %s' % quote('set -o pipefail; %s | %s' % (
+            compression.decompress_command(compressor),
+            local_command
+        ))
+
+    database_operations.prepare_local_database(django_settings)
+
+    print(green('\nStreaming backup into local database.'))
+    bytes_received, seconds = stream.stream_to_local(
+        'bash -c %s' % quote('set -o pipefail; %s' % remote_command),
+        local_command
+    )
+    stream.print_transfer('Restored', bytes_received, seconds)
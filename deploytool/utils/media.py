@@ -0,0 +1,204 @@
+import os
+import tempfile
+import threading
+import time
+from pipes import quote
+
+from fabric.api import *
+from fabric.colors import *
+
+import commands
+import stream
+
+
+# reads the file list on stdin completely, before the command writes anything
+READ_FILE_LIST = 'files=$(cat) && printf "%%s\\n" "$files" | %s'
+
+
+def get_remote_manifest(media_path):
+    """ Returns dict of {relative path: (size, mtime)} for all files in remote media_path """
+
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run('[ -d %s ] && find %s -type f -printf "%%P\\t%%s\\t%%T@\\n"; true' % (media_path, media_path))
+
+    manifest = {}
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 3:
+            manifest[fields[0]] = (int(fields[1]), int(float(fields[2])))
+
+    return manifest
+
+
+def get_local_manifest(media_path):
+    """ Returns dict of {relative path: (size, mtime)} for all files in local media_path """
+
+    manifest = {}
+
+    for root, dirs, files in os.walk(media_path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                manifest[os.path.relpath(file_path, media_path)] = (stat.st_size, int(stat.st_mtime))
+
+    return manifest
+
+
+def get_local_checksums(media_path, paths):
+    """ Returns dict of {relative path: sha1} for paths in local media_path """
+
+    if not paths:
+        return {}
+
+    output = local('cd %s && printf "%%s\\0" %s | xargs -0 sha1sum' % (
+        quote(media_path),
+        ' '.join(quote('./%s' % p) for p in paths)
+    ), capture=True)
+
+    return parse_checksums(output)
+
+
+def get_remote_checksums(media_path, paths):
+    """ Returns dict of {relative path: sha1} for paths in remote media_path, in a single command """
+
+    if not paths:
+        return {}
+
+    output = stream.remote_output(
+        'cd %s && %s' % (quote(media_path), READ_FILE_LIST % 'xargs -d "\\n" sha1sum'),
+        ''.join('./%s\n' % p for p in paths)
+    )
+
+    return parse_checksums(output)
+
+
+def parse_checksums(output):
+    """ Returns dict of {relative path: sha1} from sha1sum output for ./ prefixed paths """
+
+    checksums = {}
+    for line in output.splitlines():
+        if '  ./' in line:
+            checksum, path = line.split('  ./', 1)
+            checksums[path] = checksum
+
+    return checksums
+
+
+def get_changed_files(source_manifest, target_manifest, checksums=None):
+    """
+    Returns sorted list of paths missing or different in target
+    Files of equal size are compared by mtime, or by checksums when given as (source, target) functions.
+    """
+
+    changed = []
+    compare = []
+
+    for path, (size, mtime) in source_manifest.items():
+        if '\n' in path or '\t' in path:
+            print(yellow('Skipping %r, its name contains a newline or tab.' % path))
+        elif path not in target_manifest or target_manifest[path][0] != size:
+            changed.append(path)
+        elif target_manifest[path][1] != mtime:
+            compare.append(path)
+
+    if checksums:
+        source_checksums = checksums[0](compare)
+        target_checksums = checksums[1](compare)
+        changed.extend(p for p in compare if source_checksums.get(p) != target_checksums.get(p))
+    else:
+        changed.extend(compare)
+
+    return sorted(changed)
+
+
+def split_batches(paths, manifest, count):
+    """ Returns up to count lists of paths, with about the same total size each """
+
+    batches = [[] for i in range(count)]
+    sizes = [0] * count
+
+    for path in sorted(paths, key=lambda p: manifest[p][0], reverse=True):
+        smallest = sizes.index(min(sizes))
+        batches[smallest].append(path)
+        sizes[smallest] += manifest[path][0]
+
+    return [batch for batch in batches if batch]
+
+
+def run_parallel(function, batches):
+    """ Run function for every batch in its own thread, abort when any of them failed """
+
+    errors = []
+
+    def worker(batch):
+        try:
+            function(batch)
+        except BaseException, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(batch, )) for batch in batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        abort(red('Media sync failed: %s' % errors[0]))
+
+
+def sync_media(remote_media_path, local_media_path, push=False, checksum=False):
+    """
+    Transfer only missing or changed media files, from remote to local or with push from local to remote
+    Files are sent as tar streams over `media_sync_workers` parallel SSH channels. Nothing is deleted.
+    """
+
+    print(green('\nComparing media files.'))
+    remote_manifest = get_remote_manifest(remote_media_path)
+    local_manifest = get_local_manifest(local_media_path)
+
+    remote_checksums = lambda paths: get_remote_checksums(remote_media_path, paths)
+    local_checksums = lambda paths: get_local_checksums(local_media_path, paths)
+
+    if push:
+        manifest = local_manifest
+        changed = get_changed_files(local_manifest, remote_manifest, checksum and (local_checksums, remote_checksums))
+    else:
+        manifest = remote_manifest
+        changed = get_changed_files(remote_manifest, local_manifest, checksum and (remote_checksums, local_checksums))
+
+    total_size = sum(manifest[p][0] for p in changed)
+    print('%d of %d files changed, %s.' % (len(changed), len(manifest), commands.format_size(total_size)))
+
+    if not changed:
+        return
+
+    def pull(batch):
+        stream.stream_to_local(
+            'cd %s && %s' % (quote(remote_media_path), READ_FILE_LIST % 'tar -cf - -T -'),
+            'tar -C %s -xf -' % quote(local_media_path),
+            input=''.join('./%s\n' % p for p in batch),
+            progress=False
+        )
+
+    def push_batch(batch):
+        file_list = tempfile.NamedTemporaryFile()
+        file_list.write(''.join('./%s\n' % p for p in batch))
+        file_list.flush()
+
+        try:
+            stream.stream_to_remote(
+                'tar -C %s -T %s -cf -' % (quote(local_media_path), file_list.name),
+                'mkdir -p %s && cd %s && tar --unlink-first -xf -' % (quote(remote_media_path), quote(remote_media_path))
+            )
+        finally:
+            file_list.close()
+
+    batches = split_batches(changed, manifest, env.media_sync_workers)
+
+    print(green('\n%s media files in %d parallel batches.' % (push and 'Pushing' or 'Pulling', len(batches))))
+    local('mkdir -p %s' % quote(local_media_path))
+
+    start = time.time()
+    run_parallel(push and push_batch or pull, batches)
+    stream.print_transfer('Transferred', total_size, time.time() - start)
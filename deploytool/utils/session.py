@@ -0,0 +1,37 @@
+import time
+
+from fabric.api import *
+from fabric.colors import *
+from fabric.network import normalize_to_string
+from fabric.state import connections
+
+
+def get_connection():
+    """
+    Returns the SSH connection to the current host, shared for the whole fab session
+
+    Fabric caches one connection per host and opens a new channel on it for every run(), sudo(), get() and put(),
+    so all helpers, tasks and database operations multiplex over this connection.
+    A connection that was dropped (e.g. during a long local command) is replaced by a new one.
+    Keepalive is also enabled on connections Fabric opened before, e.g. for a run() outside a task.
+    """
+
+    key = normalize_to_string(env.host_string)
+
+    if key in connections:
+        transport = connections[key].get_transport()
+
+        if transport is not None and transport.is_active():
+            transport.set_keepalive(env.ssh_keepalive)
+            return connections[key]
+
+        print(yellow('Connection to %s was lost, reconnecting.' % env.host_string))
+        del connections[key]
+
+    start = time.time()
+    connection = connections[key]
+    connection.get_transport().set_keepalive(env.ssh_keepalive)
+
+    print('Connected to %s in %.2f seconds.' % (env.host_string, time.time() - start))
+
+    return connection
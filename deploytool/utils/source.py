@@ -1,25 +1,201 @@
+import hashlib
+import os
+from fnmatch import fnmatch
+from pipes import quote
+
 from fabric.api import *
 from fabric.colors import *
 
+import artifacts
+import compression
+import stream
+
 
-def transfer_source(upload_path, tree):
+def transfer_source(upload_path, tree, paths=None):
     """
     Archive source and upload/extract to/on remote server
         upload_path =>  target location to extract on remote
         tree        =>  git ID for branch, commit or tag
+        paths       =>  optional list of paths to limit the archive to
     """
 
-    tar_file = 'source.tar'
+    # unique per process, parallel deploys transfer from the same working directory
+    tar_file = 'source-%d.tar' % os.getpid()
+
+    # full archives are kept in the local artifact store, for later deploys of the same commit
+    if not paths and env.artifact_cache:
+        upload_archive(build_source_archive(tree), upload_path)
+        return
+
+    if paths:
+        tree = get_partial_tree(tree, paths)
+
+    if env.upload_method == 'stream':
+        stream.upload_tar('git archive --format=tar %s' % tree, upload_path)
+        return
+
     local('git archive --format=tar --output=%s %s' % (tar_file, tree))
     uploaded_files = put(tar_file, upload_path)
 
     if uploaded_files.succeeded:
         with cd(upload_path):
-            run('tar -xf %s' % uploaded_files[0])
+            # unlink first, so hardlinked files of other instances are never written to
+            run('tar --unlink-first -xf %s' % uploaded_files[0])
             run('rm -f ./%s' % tar_file)
         local('rm -f ./%s' % tar_file)
 
 
+def get_partial_tree(tree, paths):
+    """
+    Returns git ID of a tree with only the given paths of tree
+    It is written from a temporary index, so the paths never end up on a command line.
+    """
+
+    index_file = os.path.abspath('.partial-index-%d' % os.getpid())
+    entries_file = '%s.entries' % index_file
+
+    wanted_paths = set(paths)
+    output = local('git ls-tree -r -z --full-tree %s' % tree, capture=True)
+
+    # <mode> <type> <object>\t<path>, the format `update-index --index-info` reads
+    entries = [e for e in output.split('\0') if e and e.split('\t', 1)[1] in wanted_paths]
+
+    with open(entries_file, 'w') as f:
+        f.write(''.join('%s\0' % e for e in entries))
+
+    try:
+        local('GIT_INDEX_FILE=%s git update-index -z --index-info < %s' % (index_file, entries_file))
+        return local('GIT_INDEX_FILE=%s git write-tree' % index_file, capture=True).strip()
+    finally:
+        local('rm -f %s %s' % (index_file, entries_file))
+
+
+def build_source_archive(tree):
+    """ Returns path to gzipped source archive for tree in the local artifact store """
+
+    return artifacts.create_artifact(
+        tree,
+        'source.tar.gz',
+        'git archive --format=tar.gz --output=%%(output)s %s' % tree
+    )
+
+
+def transfer_source_delta(upload_path, tree, previous_path, previous_tree):
+    """
+    Hardlink previous source and upload/extract changed files only
+        upload_path     =>  target location to extract on remote
+        tree            =>  git ID for branch, commit or tag
+        previous_path   =>  source location of the currently deployed instance
+        previous_tree   =>  git ID deployed at previous_path
+    """
+
+    changed_paths, deleted_paths = get_changed_paths(previous_tree, tree)
+
+    run('cp -al %s/. %s' % (previous_path, upload_path))
+
+    with cd(upload_path):
+        # links into the vhost are recreated for this instance later on: media, and static files collected with
+        # `collectstatic --link`, which would otherwise keep pointing at (and break with) the oldest instance
+        run('find . -type l -lname %s -delete' % quote('%s/*' % env.vhost_path))
+
+        if deleted_paths:
+            # python 2 still imports the compiled files of a deleted module
+            compiled_paths = ['%s%s' % (p, c) for p in deleted_paths if p.endswith('.py') for c in 'co']
+            folders = sorted(set(os.path.dirname(p) for p in deleted_paths if os.path.dirname(p)))
+
+            for chunk in split_paths(deleted_paths + compiled_paths):
+                run('rm -f -- %s' % ' '.join(quote(p) for p in chunk))
+            for chunk in split_paths(folders):
+                run('rmdir -p --ignore-fail-on-non-empty -- %s' % ' '.join(quote(p) for p in chunk))
+
+    if changed_paths:
+        transfer_source(upload_path, tree, changed_paths)
+
+    print('%d changed and %d deleted files.' % (len(changed_paths), len(deleted_paths)))
+
+
+def split_paths(paths, size=500):
+    """ Returns paths in chunks small enough for a single command line """
+
+    return [paths[i:i + size] for i in range(0, len(paths), size)]
+
+
+def get_changed_paths(from_tree, to_tree):
+    """
+    Returns tuple with lists of (added or modified paths, deleted paths) between two trees
+    Renames are reported as a delete and an add.
+    """
+
+    output = local('git diff --name-status --no-renames -z %s %s' % (from_tree, to_tree), capture=True)
+    fields = [f for f in output.split('\0') if f != '']
+
+    changed_paths = []
+    deleted_paths = []
+
+    for status, path in zip(fields[0::2], fields[1::2]):
+        if status == 'D':
+            deleted_paths.append(path)
+        else:
+            changed_paths.append(path)
+
+    return changed_paths, deleted_paths
+
+
+def get_schema_changes(from_tree, to_tree):
+    """ Returns changed or deleted paths between two trees matching `schema_pathspecs` """
+
+    changed_paths, deleted_paths = get_changed_paths(from_tree, to_tree)
+
+    return [
+        path for path in changed_paths + deleted_paths
+        if any(fnmatch(path, pathspec) for pathspec in env.schema_pathspecs)
+    ]
+
+
+def get_tree_size(tree):
+    """ Returns total size in bytes of the files in tree """
+
+    output = local('git ls-tree -r -l --full-tree %s' % tree, capture=True)
+    size = 0
+
+    for line in output.split('\n'):
+        if not line:
+            continue
+
+        # <mode> <type> <object> <size>\t<path>, size is '-' for submodules
+        blob_size = line.split('\t', 1)[0].split()[3]
+        if blob_size.isdigit():
+            size += int(blob_size)
+
+    return size
+
+
+def upload_archive(archive_file, upload_path):
+    """ Upload local gzipped tar archive and extract it on remote server """
+
+    if env.upload_method == 'stream':
+        compressor = compression.negotiate(env.upload_compression)
+        local_command = 'cat %s' % archive_file
+
+        # stored archives are gzipped, recompress for any other `upload_compression`
+        if compressor != 'gzip':
+            local_command = 'gzip -dc %s' % archive_file
+            if compressor:
+                local_command = '%s | %s' % (local_command, compression.compress_command(compressor))
+
+        stream.extract_stream(local_command, compressor, upload_path)
+        return
+
+    uploaded_files = put(archive_file, upload_path)
+
+    if uploaded_files.succeeded:
+        with cd(upload_path):
+            run('tar --unlink-first -xzf %s' % uploaded_files[0])
+            run('rm -f %s' % uploaded_files[0])
+    else:
+        abort(red('Could not upload %s.' % archive_file))
+
+
 def compass_compile(upload_path, tree, compass_version):
     """
     Check your local compass version
@@ -27,36 +203,114 @@ def compass_compile(upload_path, tree, compass_version):
     Upload local static dir to remote
     """
 
-    local_compass_version = local('compass _' + compass_version + '_ version -q', capture=True)
-    if (local_compass_version == compass_version):
-        local_tmp_dir = '.compass_compile_tmp'
-        local_tmp_tar = 'compass_compile_tmp.tar'
+    if env.artifact_cache:
+        upload_archive(build_static_bundle(tree, compass_version), upload_path)
+        return
 
-        local('git archive --output=%s %s' % (local_tmp_tar, tree))
-        local('mkdir -p %s' % local_tmp_dir)
-        local('tar -C %s -xf %s' % (local_tmp_dir, local_tmp_tar))
-        local('compass _' + compass_version + '_ clean && compass _' + compass_version + '_ compile %s --environment production' % local_tmp_dir)
+    compass_paths = get_compass_inputs(tree, compass_version)[0]
+    local_tmp_dir = run_compass(tree, compass_version, compass_paths)
 
+    # upload static files
+    if env.upload_method == 'stream':
+        stream.upload_tar('tar -C %s -cf - static' % local_tmp_dir, upload_path)
+    else:
         local_static_tar = 'static.tar'
         local('tar -C %s -cf %s %s' % (local_tmp_dir, local_static_tar, 'static'))
         upload_static = put(local_static_tar, upload_path)
 
-        # upload static files
         if upload_static.succeeded:
             with cd(upload_path):
-                run('tar -xf %s' % upload_static[0])
+                run('tar --unlink-first -xf %s' % upload_static[0])
                 run('rm -f ./%s' % local_static_tar)
 
-            # remove local .tmp dir and tar files, recompile compass project
-            local('rm -f %s' % local_tmp_tar)
             local('rm -f %s' % local_static_tar)
-            local('rm -rf %s' % local_tmp_dir)
-            local('compass _' + compass_version + '_ clean && compass _' + compass_version + '_ compile')
         else:
+            local('rm -f %s' % local_static_tar)
+            local('rm -rf %s' % local_tmp_dir)
             abort(red('Deploy aborted because compass compiling failed.'))
-    else:
+
+    finish_compass(compass_version, local_tmp_dir)
+
+
+def build_static_bundle(tree, compass_version):
+    """
+    Returns path to gzipped static dir compiled for tree in the local artifact store
+    Compass only runs when no bundle was compiled from identical stylesheet sources before.
+    """
+
+    bundle_name = 'static.tar.gz'
+    compass_paths, compass_key = get_compass_inputs(tree, compass_version)
+
+    bundle_file = artifacts.lookup_artifact(compass_key, bundle_name)
+
+    if not bundle_file:
+        local_tmp_dir = run_compass(tree, compass_version, compass_paths)
+
+        local_static_tar = 'static-%d.tar.gz' % os.getpid()
+        local('tar -C %s -czf %s %s' % (local_tmp_dir, local_static_tar, 'static'))
+        bundle_file = artifacts.store_artifact(compass_key, bundle_name, local_static_tar)
+
+        finish_compass(compass_version, local_tmp_dir)
+
+    return bundle_file
+
+
+def run_compass(tree, compass_version, compass_paths):
+    """ Compile compass sources of tree for production in a temporary dir, and return that dir """
+
+    local_compass_version = local('compass _' + compass_version + '_ version -q', capture=True)
+    if (local_compass_version != compass_version):
         abort(red('Deploy aborted because your local compass version is different from deploy settings.'))
 
+    local_tmp_dir = '.compass_compile_tmp'
+
+    # only extract what compass needs to compile, from a tree so the paths don't go on the command line
+    local('mkdir -p %s' % local_tmp_dir)
+    local('git archive --format=tar %s | tar -C %s -xf -' % (get_partial_tree(tree, compass_paths), local_tmp_dir))
+    result = local('compass _' + compass_version + '_ clean && compass _' + compass_version + '_ compile %s --environment production' % local_tmp_dir)
+
+    # never upload, or store in the artifact cache, the output of a failed compile
+    if result.failed:
+        local('rm -rf %s' % local_tmp_dir)
+        abort(red('Deploy aborted because compass compiling failed.'))
+
+    return local_tmp_dir
+
+
+def finish_compass(compass_version, local_tmp_dir):
+    """ Remove local .tmp dir, recompile compass project """
+
+    local('rm -rf %s' % local_tmp_dir)
+    if env.compass_recompile_local:
+        local('compass _' + compass_version + '_ clean && compass _' + compass_version + '_ compile')
+
+
+def get_compass_inputs(tree, compass_version):
+    """
+    Returns tuple of (paths matching `compass_pathspecs` in tree, key for the compiled output)
+    The key is a hash of the compass version and the git blob ids of those paths.
+    """
+
+    output = local('git ls-tree -r --full-tree %s' % tree, capture=True)
+
+    paths = []
+    compass_hash = hashlib.sha1(compass_version)
+
+    for line in output.split('\n'):
+        if not line:
+            continue
+
+        # <mode> <type> <object>\t<path>
+        info, path = line.split('\t', 1)
+        if any(fnmatch(path, pathspec) for pathspec in env.compass_pathspecs):
+            paths.append(path)
+            compass_hash.update('%s %s\n' % (info, path))
+
+    if not paths:
+        abort(red('Deploy aborted because no compass sources match %s.' % ', '.join(env.compass_pathspecs)))
+
+    return paths, 'compass-%s' % compass_hash.hexdigest()
+
 
 def create_tag(tag):
 
@@ -0,0 +1,273 @@
+import hashlib
+import os
+import subprocess
+import sys
+import time
+from pipes import quote
+
+from fabric.api import *
+from fabric.colors import *
+
+import commands
+import compression
+import session
+
+
+CHUNK_SIZE = 64 * 1024
+
+# copies stdin to stdout and writes its sha1 to stderr, runs on python 2.6+ and 3
+SHA1_TEE_SCRIPT = r'''
+import hashlib, sys
+stdin = getattr(sys.stdin, "buffer", sys.stdin)
+stdout = getattr(sys.stdout, "buffer", sys.stdout)
+checksum = hashlib.sha1()
+while True:
+    chunk = stdin.read(65536)
+    if not chunk:
+        break
+    checksum.update(chunk)
+    stdout.write(chunk)
+stdout.flush()
+sys.stderr.write("sha1:%s\n" % checksum.hexdigest())
+'''
+
+
+def open_channel(command):
+    """ Execute command on a new channel of the (cached) SSH connection for the current host """
+
+    channel = session.get_connection().get_transport().open_session()
+    channel.exec_command(command)
+
+    return channel
+
+
+def stream_to_remote(local_command, remote_command):
+    """
+    Pipe output of a local command into a remote command over a single SSH channel
+    Returns tuple of (bytes sent, seconds elapsed)
+    """
+
+    start = time.time()
+    process = subprocess.Popen(local_command, shell=True, stdout=subprocess.PIPE)
+    channel = open_channel(remote_command)
+
+    bytes_sent = 0
+    errors = []
+
+    while True:
+        chunk = process.stdout.read(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        channel.sendall(chunk)
+        bytes_sent += len(chunk)
+
+        # drain remote output, a full window would block the transfer
+        while channel.recv_stderr_ready():
+            errors.append(channel.recv_stderr(CHUNK_SIZE))
+        while channel.recv_ready():
+            channel.recv(CHUNK_SIZE)
+
+    channel.shutdown_write()
+    local_status = process.wait()
+    remote_status = channel.recv_exit_status()
+
+    while channel.recv_stderr_ready():
+        errors.append(channel.recv_stderr(CHUNK_SIZE))
+    channel.close()
+
+    if local_status != 0:
+        abort(red('Stream failed, local command exited with %d: %s' % (local_status, local_command)))
+    if remote_status != 0:
+        abort(red('Stream failed, remote command exited with %d: %s\n%s' % (remote_status, remote_command, ''.join(errors))))
+
+    return bytes_sent, time.time() - start
+
+
+def receive(channel, output, progress=True):
+    """
+    Copy output of channel into file object until the remote command is done, showing live throughput with progress
+    Returns tuple of (bytes received, sha1 of the received bytes, remote exit status, remote stderr)
+    """
+
+    start = time.time()
+    checksum = hashlib.sha1()
+    bytes_received = 0
+    errors = []
+    reported_at = start
+
+    while True:
+        chunk = channel.recv(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        output.write(chunk)
+        checksum.update(chunk)
+        bytes_received += len(chunk)
+
+        while channel.recv_stderr_ready():
+            errors.append(channel.recv_stderr(CHUNK_SIZE))
+
+        # live throughput, once a second
+        if progress and time.time() - reported_at >= 1:
+            reported_at = time.time()
+            sys.stdout.write('\rReceived %s (%s/s).' % (
+                commands.format_size(bytes_received),
+                commands.format_size(bytes_received / (reported_at - start))
+            ))
+            sys.stdout.flush()
+
+    if reported_at != start:
+        sys.stdout.write('\n')
+
+    remote_status = channel.recv_exit_status()
+
+    while channel.recv_stderr_ready():
+        errors.append(channel.recv_stderr(CHUNK_SIZE))
+    channel.close()
+
+    return bytes_received, checksum.hexdigest(), remote_status, ''.join(errors)
+
+
+def stream_from_remote(remote_command, local_path):
+    """
+    Write output of a remote command to a local file while it is produced, over a single SSH channel
+    Returns tuple of (bytes received, seconds elapsed, sha1 of the received bytes, remote stderr)
+    """
+
+    start = time.time()
+    channel = open_channel(remote_command)
+    local_file = open(local_path, 'wb')
+
+    try:
+        bytes_received, checksum, remote_status, errors = receive(channel, local_file)
+    finally:
+        local_file.close()
+
+    if remote_status != 0:
+        os.remove(local_path)
+        abort(red('Stream failed, remote command exited with %d: %s\n%s' % (remote_status, remote_command, errors)))
+
+    return bytes_received, time.time() - start, checksum, errors
+
+
+def stream_to_local(remote_command, local_command, input=None, progress=True):
+    """
+    Pipe output of a remote command into a local command over a single SSH channel
+    The remote command gets input on stdin, it must read all of it before writing output.
+    Returns tuple of (bytes received, seconds elapsed)
+    """
+
+    start = time.time()
+    process = subprocess.Popen(local_command, shell=True, stdin=subprocess.PIPE)
+    channel = open_channel(remote_command)
+
+    if input is not None:
+        channel.sendall(input)
+        channel.shutdown_write()
+
+    try:
+        bytes_received, checksum, remote_status, errors = receive(channel, process.stdin, progress)
+    except IOError:
+        # local command stopped reading, its exit status tells why
+        channel.close()
+        remote_status, errors = None, ''
+        bytes_received = 0
+
+    process.stdin.close()
+    local_status = process.wait()
+
+    if local_status != 0:
+        abort(red('Stream failed, local command exited with %d: %s' % (local_status, local_command)))
+    if remote_status != 0:
+        abort(red('Stream failed, remote command exited with %s: %s\n%s' % (remote_status, remote_command, errors)))
+
+    return bytes_received, time.time() - start
+
+
+def remote_output(remote_command, input):
+    """ Returns output of a remote command reading input from stdin, it must read all of it before writing output """
+
+    channel = open_channel(remote_command)
+    channel.sendall(input)
+    channel.shutdown_write()
+
+    output = []
+    while True:
+        chunk = channel.recv(CHUNK_SIZE)
+        if not chunk:
+            break
+        output.append(chunk)
+
+    remote_status = channel.recv_exit_status()
+    errors = channel.recv_stderr(CHUNK_SIZE) if channel.recv_stderr_ready() else ''
+    channel.close()
+
+    if remote_status != 0:
+        abort(red('Remote command exited with %d: %s\n%s' % (remote_status, remote_command, errors)))
+
+    return ''.join(output)
+
+
+def download_stream(remote_command, local_path):
+    """
+    Save output of a remote command to local_path, nothing is written to disk on the remote
+    The sha1 of the bytes sent by the remote is compared with the bytes received, and saved as `<local_path>.sha1`.
+    Until it is verified, the download is kept as `<local_path>.part`.
+    """
+
+    part_path = '%s.part' % local_path
+    command = 'bash -c %s' % quote('set -o pipefail; %s | python -c %s' % (remote_command, quote(SHA1_TEE_SCRIPT)))
+
+    bytes_received, seconds, received_checksum, errors = stream_from_remote(command, part_path)
+
+    sent_checksum = [l[len('sha1:'):] for l in errors.splitlines() if l.startswith('sha1:')]
+
+    if not sent_checksum or sent_checksum[-1] != received_checksum:
+        abort(red('Download failed, checksum mismatch. Partial download kept in %s' % part_path))
+
+    os.rename(part_path, local_path)
+
+    sha1_file = open('%s.sha1' % local_path, 'w')
+    sha1_file.write('%s  %s\n' % (received_checksum, os.path.basename(local_path)))
+    sha1_file.close()
+
+    print_transfer('Downloaded', bytes_received, seconds)
+    print('Verified sha1 %s.' % received_checksum)
+
+
+def upload_tar(tar_command, upload_path):
+    """
+    Stream tar archive from local command, compressed with `upload_compression`, into remote path
+    Nothing is written to disk on either side.
+    """
+
+    compressor = compression.negotiate(env.upload_compression)
+
+    if compressor:
+        tar_command = '%s | %s' % (tar_command, compression.compress_command(compressor))
+
+    extract_stream(tar_command, compressor, upload_path)
+
+
+def extract_stream(local_command, compressor, upload_path):
+    """ Extract (compressed) tar output of local command into remote path """
+
+    if compressor:
+        remote_command = 'cd %s && %s | tar --unlink-first -xf -' % (upload_path, compression.decompress_command(compressor))
+    else:
+        remote_command = 'cd %s && tar --unlink-first -xf -' % upload_path
+
+    bytes_sent, seconds = stream_to_remote(local_command, remote_command)
+    print_transfer('Streamed', bytes_sent, seconds)
+
+
+def print_transfer(action, bytes_transferred, seconds):
+    """ Output size, duration and throughput of a transfer """
+
+    print('%s %s in %.1f seconds (%s/s).' % (
+        action,
+        commands.format_size(bytes_transferred),
+        seconds,
+        commands.format_size(bytes_transferred / max(seconds, 0.001))
+    ))
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pipes import quote
+
+from fabric.api import *
+from fabric.colors import *
+
+import commands
+import stream
+
+
+def get_state_path(local_path):
+    """ Returns path of the file recording the progress of a download to local_path """
+
+    return '%s.transfer' % local_path
+
+
+def read_state(local_path):
+    """ Returns recorded state of an interrupted download to local_path, or None """
+
+    state_path = get_state_path(local_path)
+
+    if not os.path.exists(state_path) or not os.path.exists('%s.part' % local_path):
+        return None
+
+    try:
+        state_file = open(state_path)
+        try:
+            return json.load(state_file)
+        finally:
+            state_file.close()
+    except ValueError:
+        return None
+
+
+def write_state(local_path, state):
+    """ Atomically replace the state file of a download to local_path """
+
+    state_path = get_state_path(local_path)
+    state_file = open('%s.tmp' % state_path, 'w')
+    json.dump(state, state_file)
+    state_file.close()
+
+    os.rename('%s.tmp' % state_path, state_path)
+
+
+def get_partial_download(local_path):
+    """ Returns remote path of an interrupted download to local_path, if it can be resumed """
+
+    state = read_state(local_path)
+
+    if state and commands.path_exists(state['remote_path']):
+        return state['remote_path']
+
+    return None
+
+
+def download_file(remote_path, local_path, delete_remote=True):
+    """
+    Download remote file in chunks over `transfer_workers` parallel channels
+
+        - every chunk is checksummed on both ends, and recorded in `<local_path>.transfer` when it matches
+        - an interrupted download continues with the missing chunks when run again
+        - the remote file is only deleted when the checksum of the whole file matches
+    """
+
+    with settings(hide('running', 'stdout')):
+        size, mtime = [int(f) for f in run('stat -c "%%s %%Y" %s' % remote_path).split()]
+
+    chunk_size = env.transfer_chunk_size * 1024 * 1024
+    chunk_count = max(1, (size + chunk_size - 1) // chunk_size)
+    part_path = '%s.part' % local_path
+
+    state = read_state(local_path)
+
+    if state and (state['remote_path'], state['size'], state['mtime'], state['chunk_size']) == (
+            remote_path, size, mtime, chunk_size):
+        print('Resuming download, %d of %d chunks done.' % (len(state['chunks']), chunk_count))
+    else:
+        state = {'remote_path': remote_path, 'size': size, 'mtime': mtime, 'chunk_size': chunk_size, 'chunks': {}}
+
+        part_file = open(part_path, 'wb')
+        part_file.truncate(size)
+        part_file.close()
+
+        write_state(local_path, state)
+
+    pending = [i for i in range(chunk_count) if str(i) not in state['chunks']]
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                if not pending or errors:
+                    return
+                index = pending.pop(0)
+
+            try:
+                checksum = download_chunk(remote_path, part_path, index, env.transfer_chunk_size)
+            except BaseException, e:
+                with lock:
+                    errors.append(e)
+                return
+
+            with lock:
+                state['chunks'][str(index)] = checksum
+                write_state(local_path, state)
+
+    start = time.time()
+    bytes_pending = size - len(state['chunks']) * chunk_size
+
+    threads = [threading.Thread(target=worker) for i in range(env.transfer_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        abort(red('Download failed, run again to resume: %s' % errors[0]))
+
+    stream.print_transfer('Downloaded', max(bytes_pending, 0), time.time() - start)
+    verify_download(remote_path, part_path)
+
+    os.rename(part_path, local_path)
+    os.remove(get_state_path(local_path))
+
+    if delete_remote:
+        commands.delete(remote_path)
+
+
+def download_chunk(remote_path, part_path, index, chunk_megabytes):
+    """ Write chunk with index of remote file into local part file, returns its sha1 after checking it on both ends """
+
+    remote_command = 'bash -c %s' % quote('set -o pipefail; dd if=%s bs=1M skip=%d count=%d 2>/dev/null | python -c %s' % (
+        remote_path,
+        index * chunk_megabytes,
+        chunk_megabytes,
+        quote(stream.SHA1_TEE_SCRIPT)
+    ))
+
+    part_file = open(part_path, 'r+b')
+
+    try:
+        part_file.seek(index * chunk_megabytes * 1024 * 1024)
+        channel = stream.open_channel(remote_command)
+        bytes_received, checksum, remote_status, errors = stream.receive(channel, part_file, progress=False)
+    finally:
+        part_file.close()
+
+    sent_checksum = [l[len('sha1:'):] for l in errors.splitlines() if l.startswith('sha1:')]
+
+    if remote_status != 0 or not sent_checksum or sent_checksum[-1] != checksum:
+        raise Exception('chunk %d of %s failed (exit status %d).' % (index, remote_path, remote_status))
+
+    return checksum
+
+
+def verify_download(remote_path, part_path):
+    """ Compare sha1 of the remote file and the downloaded file, computed on both ends at the same time """
+
+    remote_checksum = []
+    thread = threading.Thread(target=lambda: remote_checksum.append(stream.remote_output('sha1sum %s' % remote_path, '')))
+    thread.start()
+
+    checksum = hashlib.sha1()
+    part_file = open(part_path, 'rb')
+
+    try:
+        while True:
+            chunk = part_file.read(stream.CHUNK_SIZE * 16)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    finally:
+        part_file.close()
+
+    thread.join()
+
+    if not remote_checksum or remote_checksum[0].split()[0] != checksum.hexdigest():
+        os.remove(get_state_path(part_path[:-len('.part')]))
+        abort(red('Download failed, checksum of %s does not match. Run again to download it again.' % remote_path))
+
+    print('Verified sha1 %s.' % checksum.hexdigest())
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import uuid
+
+from fabric.api import *
+from fabric.colors import *
+
+import artifacts
+import commands
+import source
+
+
+def get_wheelhouse_key(tree):
+    """ Returns artifact key for the wheels of requirements.txt in tree and the configured build target """
+
+    requirements = local('git show %s:requirements.txt' % tree, capture=True)
+    build_target = env.wheel_build_image or local('python -V 2>&1', capture=True)
+
+    wheelhouse_hash = hashlib.sha1('%s\n%s' % (build_target, requirements))
+    return 'wheels-%s' % wheelhouse_hash.hexdigest()
+
+
+def build_wheelhouse(tree):
+    """
+    Returns path to gzipped wheelhouse for requirements.txt in tree, in the local artifact store
+    Wheels are built locally, or in a `wheel_build_image` docker container matching the remote python.
+    """
+
+    wheelhouse_key = get_wheelhouse_key(tree)
+    wheelhouse_file = artifacts.lookup_artifact(wheelhouse_key, 'wheelhouse.tar.gz')
+
+    if not wheelhouse_file:
+        local_tmp_dir = os.path.abspath('.wheelhouse_tmp_%d' % os.getpid())
+
+        local('mkdir -p %s' % local_tmp_dir)
+        local('git show %s:requirements.txt > %s/requirements.txt' % (tree, local_tmp_dir))
+
+        if env.wheel_build_image:
+            print('Building wheels in %s.' % env.wheel_build_image)
+            result = local('docker run --rm -v %s:/wheelhouse %s sh -c "%s && chown -R %d:%d /wheelhouse"' % (
+                local_tmp_dir,
+                env.wheel_build_image,
+                'pip wheel --wheel-dir=/wheelhouse -r /wheelhouse/requirements.txt',
+                os.getuid(),
+                os.getgid()
+            ))
+        else:
+            result = local('pip wheel --wheel-dir=%s -r %s/requirements.txt' % (local_tmp_dir, local_tmp_dir))
+
+        if result.failed:
+            local('rm -rf %s' % local_tmp_dir)
+            abort(red('Could not build wheels for requirements.txt.'))
+
+        local_wheelhouse_tar = 'wheelhouse-%d.tar.gz' % os.getpid()
+        local('tar -C %s -czf %s .' % (local_tmp_dir, local_wheelhouse_tar))
+        local('rm -rf %s' % local_tmp_dir)
+
+        wheelhouse_file = artifacts.store_artifact(wheelhouse_key, 'wheelhouse.tar.gz', local_wheelhouse_tar)
+
+    print('Wheelhouse is %s.' % commands.format_size(os.path.getsize(wheelhouse_file)))
+    return wheelhouse_file
+
+
+def upload_wheelhouse(tree, upload_path):
+    """ Build (or reuse) wheelhouse for tree and extract it in upload_path on remote server """
+
+    commands.create_folder(upload_path)
+    source.upload_archive(build_wheelhouse(tree), upload_path)
+
+
+def upload_shared_wheelhouse(tree, shared_cache_path):
+    """
+    Returns remote path of the wheelhouse for tree in the host-wide shared cache
+    It is only uploaded when no other instance or project put it there before.
+    The upload is extracted to a temporary folder and renamed into place, so it appears atomically.
+    """
+
+    wheelhouse_path = os.path.join(shared_cache_path, 'wheels', get_wheelhouse_key(tree))
+
+    if exists(wheelhouse_path):
+        print('Using wheelhouse from shared cache.')
+        run('touch %s' % wheelhouse_path)
+        return wheelhouse_path
+
+    tmp_path = '%s.tmp-%s' % (wheelhouse_path, uuid.uuid4().hex)
+    run('mkdir %s' % tmp_path)
+    source.upload_archive(build_wheelhouse(tree), tmp_path)
+
+    # other project users may prune it, a concurrent upload may have won the race
+    run('chmod -R g+w %s' % tmp_path)
+    run('mv -T %s %s || rm -rf %s' % (tmp_path, wheelhouse_path, tmp_path))
+
+    return wheelhouse_path
@@ -43,12 +43,14 @@ status = tasks.remote.Status()
 size = tasks.remote.Size()
 diff = tasks.remote.Diff()
 media = tasks.remote.Media()
+media_sync = tasks.remote.MediaSync()
 database = tasks.remote.Database()
 test = tasks.remote.Test()
 
 # provisioning
 setup = tasks.provision.Setup()
 keys = tasks.provision.Keys()
+setup_shared_cache = tasks.provision.SharedCache()
 
 # generic
 list_tasks = tasks.generic.ListTasks()